@@ -1,42 +1,504 @@
 import os
+
+# inductor 编译缓存放在应用目录下，容器重启后可直接复用（需在 import torch 之前设置）
+os.environ.setdefault(
+    "TORCHINDUCTOR_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".torchinductor_cache"),
+)
+# CUDA 缓存分配器：可扩展显存段减少碎片，大块显存不再拆分（需在 import torch 之前设置）
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+)
+
 import io
-import base64
 import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Literal
 import torch
 from PIL import Image
 import gradio as gr
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
+from diffusers import FluxTransformer2DModel
 from modelscope import FluxPipeline
 from loguru import logger
 
+try:
+    # pybase64 使用 SIMD（SSSE3 / AVX2 / NEON）加速 base64 编解码，接口与标准库一致
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+try:
+    import orjson  # noqa: F401
+
+    # orjson 序列化数 MB 的 base64 字符串远快于标准库 json
+    from fastapi.responses import ORJSONResponse as JSONResponse
+except ImportError:
+    from fastapi.responses import JSONResponse
+
+if hasattr(base64, "get_version"):
+    logger.info(f"base64 后端: pybase64 {base64.get_version()}")
+else:
+    logger.info("未安装 pybase64，使用标准库 base64")
+
+# 纯推理服务：允许 TF32 矩阵乘并开启 cuDNN 卷积算法自动选择。
+# 梯度模式是线程局部的，推理都在 GPU 线程上执行，因此不在导入时全局关闭 autograd，
+# 而是依赖每次调用的 torch.inference_mode() 和加载后对参数的 requires_grad_(False)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+# Transformer 量化方式：auto / fp8 / nvfp4 / none
+# auto 在支持 FP8 的显卡（算力 >= 8.9，即 Ada / Hopper 及以上）上使用 FP8，否则保持 bf16
+TRANSFORMER_QUANT = os.getenv("TRANSFORMER_QUANT", "auto").lower()
+
+# 动态批处理：单批最大请求数与凑批等待时间（秒）
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+MAX_BATCH_DELAY = float(os.getenv("MAX_BATCH_DELAY", "0.1"))
+
+# 提示词编码缓存的最大条目数（每条约 4MB 显存，0 表示关闭缓存）
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+
+# 量化时保持 bf16 的顶层模块：输入嵌入、时间 / 文本嵌入和输出层，对精度敏感且只占很小的权重比例。
+# 各 block 内的 AdaLayerNorm 调制线性层（norm1 / norm1_context / norm，输出宽 18432）约占
+# Transformer 权重的 30%，正常参与量化。名字只匹配顶层模块：单流 block 内同样有名为 proj_out 的
+# 线性层（38 个 15360→3072，计算量很大），必须参与量化
+QUANT_SKIP_MODULES = [
+    "x_embedder",
+    "context_embedder",
+    "time_text_embed",
+    "norm_out",
+    "proj_out",
+]
+
+
+# CublasLinear（fp16 累加）替换时额外跳过的 AdaLayerNorm 调制线性层，按任意层级的模块名匹配：
+# 双流 block 的 norm1 / norm1_context 与单流 block 的 norm。调制输出的 shift / scale / gate
+# 直接缩放整个残差流，对 fp16 累加误差敏感。与量化跳过列表相互独立
+CUBLAS_SKIP_MODULES = ["norm1", "norm1_context", "norm"]
+
+
+def is_quant_skipped(name: str) -> bool:
+    """
+    判断模块 / 参数是否属于 QUANT_SKIP_MODULES 中的顶层模块
+
+    Args:
+        name: 模块或参数的完整名称（如 proj_out.weight）
+
+    Returns:
+        属于跳过量化的顶层模块时返回 True
+    """
+    return name.split(".", 1)[0] in QUANT_SKIP_MODULES
+
+
+def is_cublas_skipped(name: str) -> bool:
+    """
+    判断线性层是否应保留为 nn.Linear，不替换为 CublasLinear
+
+    Args:
+        name: 线性层的完整名称（如 transformer_blocks.0.norm1.linear）
+
+    Returns:
+        属于跳过量化的顶层模块，或位于任意层级的调制线性层之内时返回 True
+    """
+    if is_quant_skipped(name):
+        return True
+    return any(part in CUBLAS_SKIP_MODULES for part in name.split("."))
+
+
+def quant_skip_param_names(model_path: str) -> List[str]:
+    """
+    列出 QUANT_SKIP_MODULES 中顶层模块的完整参数名
+
+    diffusers 的 torchao 量化器按 `key + "."` 子串（或与参数名完全相等）匹配 modules_to_not_convert，
+    裸模块名会同时命中 block 内的同名子模块；传入完整参数名则只会精确匹配顶层模块。
+    模型在 meta 设备上按配置实例化，不加载权重
+
+    Args:
+        model_path: 模型目录
+
+    Returns:
+        参数名列表
+    """
+    from accelerate import init_empty_weights
+
+    config = FluxTransformer2DModel.load_config(model_path, subfolder="transformer")
+    with init_empty_weights():
+        model = FluxTransformer2DModel.from_config(config)
+    return [name for name, _ in model.named_parameters() if is_quant_skipped(name)]
+
+
+def build_quantization_config(model_path: str):
+    """
+    根据 TRANSFORMER_QUANT 环境变量构建 Transformer 的量化配置
+
+    Args:
+        model_path: 模型目录
+
+    Returns:
+        diffusers 量化配置对象，不量化时返回 None
+    """
+    quant = TRANSFORMER_QUANT
+    if quant == "auto":
+        quant = "fp8" if torch.cuda.get_device_capability() >= (8, 9) else "none"
+    logger.info(f"Transformer 量化方式: {quant}")
+
+    if quant == "none":
+        return None
+    if quant == "fp8":
+        from diffusers import TorchAoConfig
+
+        # FP8 动态激活 + 按行缩放的权重量化（torchao）
+        return TorchAoConfig(
+            "float8dq_e4m3_row",
+            modules_to_not_convert=quant_skip_param_names(model_path),
+        )
+    if quant == "nvfp4":
+        from diffusers import NVIDIAModelOptConfig
+
+        # NVFP4 需要 Blackwell 显卡以及 nvidia-modelopt
+        config = NVIDIAModelOptConfig(quant_type="NVFP4")
+        # diffusers 会把 modules_to_not_convert 转成 "*name*" 通配符，同样会命中 block 内的同名子模块，
+        # 因此直接写入以顶层模块名开头的通配符，关闭对应的量化器
+        for name in QUANT_SKIP_MODULES:
+            config.modelopt_config["quant_cfg"][f"{name}.*"] = {"enable": False}
+        return config
+    raise ValueError(
+        f"不支持的 TRANSFORMER_QUANT: {TRANSFORMER_QUANT}，可选值: auto / fp8 / nvfp4 / none"
+    )
+
+
+class HalfCublasLinear(torch.nn.Module):
+    """使用 fp16 累加 cuBLAS GEMM 的线性层，输入输出保持原 dtype"""
+
+    def __init__(self, linear: torch.nn.Linear):
+        super().__init__()
+        from cublas_ops import CublasLinear
+
+        self.linear = CublasLinear(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            device=linear.weight.device,
+            dtype=torch.float16,
+        )
+        with torch.no_grad():
+            self.linear.weight.copy_(linear.weight.half())
+            if linear.bias is not None:
+                self.linear.bias.copy_(linear.bias.half())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.linear(x.half()).to(x.dtype)
+
+
+def replace_linear_with_cublas(model: torch.nn.Module) -> int:
+    """
+    将模型中的 nn.Linear 替换为 HalfCublasLinear（跳过 is_cublas_skipped 命中的线性层）
+
+    Args:
+        model: 待替换的模型
+
+    Returns:
+        被替换的线性层数量
+    """
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            full_name = f"{name}.{child_name}" if name else child_name
+            if not isinstance(child, torch.nn.Linear):
+                continue
+            if is_cublas_skipped(full_name):
+                continue
+            setattr(module, child_name, HalfCublasLinear(child))
+            replaced += 1
+    return replaced
+
+
+def freeze(value):
+    """将 list / dict 等参数递归转换为可哈希的元组，用于构造 CUDA Graph 缓存键"""
+    if isinstance(value, torch.Tensor):
+        raise TypeError("嵌套的张量参数无法作为缓存键")
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    hash(value)
+    return value
+
+
+class CUDAGraphForward:
+    """
+    按输入形状缓存 CUDA Graph 的 forward 包装器
+
+    capturing 为 True 时，遇到新的输入形状会捕获一个 CUDA Graph；之后形状相同的调用
+    只需把输入拷贝进静态张量并 replay，省去每步数百次 kernel launch 的开销。
+    未捕获过的形状回退到原始 forward
+    """
+
+    def __init__(self, forward):
+        self.forward = forward
+        self.graphs = {}
+        self.capturing = False
+
+    @staticmethod
+    def graph_key(kwargs: dict):
+        """构造缓存键：张量取形状/dtype/设备，其余参数取值；无法哈希时返回 None"""
+        key = []
+        for name, value in sorted(kwargs.items()):
+            if isinstance(value, torch.Tensor):
+                key.append((name, tuple(value.shape), value.dtype, value.device))
+                continue
+            try:
+                key.append((name, freeze(value)))
+            except TypeError:
+                return None
+        return tuple(key)
+
+    def capture(self, kwargs: dict):
+        """以给定输入捕获 CUDA Graph，返回 (graph, 静态输入, 静态输出)"""
+        static_kwargs = {
+            name: value.clone() if isinstance(value, torch.Tensor) else value
+            for name, value in kwargs.items()
+        }
+        # 先在旁路 stream 上预热，让 cuBLAS 等库完成惰性初始化
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(2):
+                self.forward(**static_kwargs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = self.forward(**static_kwargs)
+        return graph, static_kwargs, static_output
+
+    def __call__(self, *args, **kwargs):
+        # 只处理 return_dict=False 的纯关键字参数调用（pipeline 的调用方式）
+        if args or kwargs.get("return_dict", True):
+            return self.forward(*args, **kwargs)
+        key = self.graph_key(kwargs)
+        if key is None:
+            return self.forward(**kwargs)
+
+        if key not in self.graphs:
+            if not self.capturing:
+                return self.forward(**kwargs)
+            try:
+                self.graphs[key] = self.capture(kwargs)
+            except Exception as e:
+                logger.warning(f"CUDA Graph 捕获失败，该形状回退到常规执行: {e}")
+                self.graphs[key] = None
+        entry = self.graphs[key]
+        if entry is None:
+            return self.forward(**kwargs)
+
+        graph, static_kwargs, static_output = entry
+        for name, value in kwargs.items():
+            if isinstance(value, torch.Tensor):
+                static_kwargs[name].copy_(value)
+        graph.replay()
+        # 静态输出会在下一次 replay 时被覆盖，返回副本
+        return tuple(t.clone() for t in static_output)
+
+
 # 全局加载 pipeline
 logger.info("正在加载 pipeline...")
 # 获取环境变量MODEL_PATH
 model_path = os.getenv("MODEL_PATH")
 if model_path is None:
     raise ValueError("MODEL_PATH 环境变量未设置")
-pipeline = FluxPipeline.from_pretrained(model_path, torch_dtype=torch.bfloat16)
-pipeline.to("cuda")
+quantization_config = build_quantization_config(model_path)
+# 显存紧张时设置 FLUX_OFFLOAD=1，仅将 T5 文本编码器（最大的非热点模块）卸载到 CPU，
+# Transformer 和 VAE 始终常驻显存，避免每次请求都经 PCIe 搬运全部权重。
+# T5 单独加载到 CPU 再传给 pipeline，避免 device_map="cuda" 先把约 9.5GB 权重放进显存
+flux_offload = os.getenv("FLUX_OFFLOAD", "0") == "1"
+pipeline_components = {}
+if flux_offload:
+    from transformers import T5EncoderModel
+
+    pipeline_components["text_encoder_2"] = T5EncoderModel.from_pretrained(
+        model_path,
+        subfolder="text_encoder_2",
+        torch_dtype=torch.bfloat16,
+        low_cpu_mem_usage=True,
+    )
+# 权重直接加载到显存，避免先在内存中完整实例化一份再搬运到 GPU
+transformer = FluxTransformer2DModel.from_pretrained(
+    model_path,
+    subfolder="transformer",
+    quantization_config=quantization_config,
+    torch_dtype=torch.bfloat16,
+    low_cpu_mem_usage=True,
+    device_map="cuda",
+)
+pipeline = FluxPipeline.from_pretrained(
+    model_path,
+    transformer=transformer,
+    torch_dtype=torch.bfloat16,
+    low_cpu_mem_usage=True,
+    device_map="cuda",
+    **pipeline_components,
+)
 logger.info("pipeline 加载完成")
 
-# 启用模型 CPU offload 以节省 VRAM（如果 GPU 足够可以移除这行）
-pipeline.enable_model_cpu_offload()
+# VAE 分块 / 分片解码：大分辨率（最高 2048x2048）解码时显著降低峰值显存
+pipeline.vae.enable_tiling()
+pipeline.vae.enable_slicing()
+
+# 冻结所有组件的参数，避免 diffusers 内部的 requires_grad 检查和梯度相关开销
+for component in pipeline.components.values():
+    if isinstance(component, torch.nn.Module):
+        component.requires_grad_(False)
+
+# T5 权重留在 CPU，前向时由 accelerate 按需搬运到 GPU
+offloaded_modules = set()
+if flux_offload:
+    from accelerate import cpu_offload
+
+    cpu_offload(pipeline.text_encoder_2, execution_device=torch.device("cuda"))
+    offloaded_modules.add("text_encoder_2")
+
+logger.info(
+    "模块驻留设备: "
+    + ", ".join(
+        f"{name}=cpu(offload)"
+        if name in offloaded_modules
+        else f"{name}={next(module.parameters()).device}"
+        for name, module in pipeline.components.items()
+        if isinstance(module, torch.nn.Module)
+    )
+)
+
+# 消费级显卡（Ampere / Ada）上 fp16 累加的矩阵乘吞吐约为 fp32 累加的 2 倍，
+# 设置 CUBLAS_HGEMM=1 后使用 torch-cublas-hgemm 的 CublasLinear 替换 Transformer 线性层
+cublas_swapped = False
+if os.getenv("CUBLAS_HGEMM", "0") == "1":
+    if quantization_config is not None:
+        logger.warning("Transformer 已量化，跳过 CublasLinear 替换")
+    elif torch.cuda.get_device_capability() >= (9, 0):
+        logger.info("当前显卡 bf16 矩阵乘已可达峰值，跳过 CublasLinear 替换")
+    else:
+        replaced = replace_linear_with_cublas(pipeline.transformer)
+        logger.info(f"已将 {replaced} 个线性层替换为 CublasLinear")
+        cublas_swapped = replaced > 0
+
+# CublasLinear 调用 pybind11 扩展，Dynamo 无法追踪（fullgraph 下直接报错，
+# 否则每个线性层处都会断图，编译收益全部丢失），因此替换后不再编译
+torch_compile = os.getenv("TORCH_COMPILE", "1") == "1"
+if torch_compile and cublas_swapped:
+    logger.warning("CublasLinear 无法被 torch.compile 追踪，跳过编译")
+    torch_compile = False
+
+# 所有 GPU 工作（编译预热、CUDA Graph 捕获和推理）都在这一个专用线程上执行：
+# inductor 的 CUDA Graph 状态按线程保存，只有在同一线程上预热才能被推理复用；
+# 单线程同时保证同一时刻只有一次 pipeline 调用占用 GPU
+gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+
+
+def warmup_compile():
+    """以最常用的 1024x1024 尺寸对每种批大小各预热一次编译"""
+    for batch_size in range(1, MAX_BATCH_SIZE + 1):
+        logger.info(f"正在预热编译（1024x1024，批大小 {batch_size}）...")
+        with torch.inference_mode():
+            pipeline(
+                ["warmup"] * batch_size,
+                height=1024,
+                width=1024,
+                num_inference_steps=2,
+                max_sequence_length=512,
+            )
+
+
+# 编译 Transformer 和 VAE 解码器（TORCH_COMPILE=0 可关闭）。
+# 启动时在 GPU 线程上预热，把编译与 autotune 的耗时放在启动阶段
+if torch_compile:
+    pipeline.transformer.compile(mode="max-autotune", fullgraph=True, dynamic=False)
+    pipeline.vae.decode = torch.compile(pipeline.vae.decode, mode="max-autotune")
+
+    gpu_executor.submit(warmup_compile).result()
+    # 预热只覆盖 1024x1024，其余尺寸若在请求中触发 max-autotune 重新编译，
+    # 会在唯一的 GPU 线程上阻塞数分钟；预热之后遇到新尺寸直接以 eager 模式执行
+    torch.compiler.set_stance("eager_on_recompile")
+    logger.info("编译预热完成，未预热的尺寸将以 eager 模式执行")
+
+# 对默认尺寸（1024x1024、最大序列长度 512、批大小 1）的 Transformer 前向捕获 CUDA Graph
+# （CUDA_GRAPHS=0 可关闭）。max-autotune 编译本身已启用 CUDA Graph，因此仅在未编译时生效
+# （包括启用 CublasLinear 替换而跳过编译的情况）；
+# CPU offload 的 hook 会在前向中搬运权重，无法捕获，同样跳过
+if (
+    os.getenv("CUDA_GRAPHS", "1") == "1"
+    and not torch_compile
+    and not offloaded_modules
+):
+    graph_forward = CUDAGraphForward(pipeline.transformer.forward)
+    pipeline.transformer.forward = graph_forward
+
+    def capture_cuda_graphs():
+        """运行一次默认尺寸的推理，捕获 Transformer 前向的 CUDA Graph"""
+        graph_forward.capturing = True
+        try:
+            with torch.inference_mode():
+                pipeline(
+                    "warmup",
+                    height=1024,
+                    width=1024,
+                    num_inference_steps=2,
+                    max_sequence_length=512,
+                )
+        finally:
+            graph_forward.capturing = False
+
+    logger.info("正在捕获 CUDA Graph（1024x1024）...")
+    gpu_executor.submit(capture_cuda_graphs).result()
+    captured = sum(1 for entry in graph_forward.graphs.values() if entry is not None)
+    logger.info(f"CUDA Graph 捕获完成，共 {captured} 个")
+
+
+# 常驻的 CUDA 随机数生成器（每个批内位置一个），只在 GPU 线程上重新设置种子使用
+cuda_generators = [torch.Generator("cuda") for _ in range(MAX_BATCH_SIZE)]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动和停止动态批处理器"""
+    batcher.start()
+    yield
+    await batcher.stop()
+
 
 # 创建 FastAPI 应用
-app = FastAPI(title="FLUX.1-dev API", version="1.0.0")
-
-# 配置 CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+app = FastAPI(
+    title="FLUX.1-dev API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=JSONResponse,
 )
 
+# 配置 CORS（仅在设置 ENABLE_CORS=1 时启用，同源访问或内网调用无需 CORS 中间件）
+if os.getenv("ENABLE_CORS", "0") == "1":
+    # 允许的来源，多个用逗号分隔
+    cors_origins = [
+        origin.strip()
+        for origin in os.getenv("CORS_ALLOW_ORIGINS", "*").split(",")
+        if origin.strip()
+    ]
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=cors_origins,
+        # 规范不允许通配来源携带凭据
+        allow_credentials=cors_origins != ["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    logger.info(f"已启用 CORS，允许的来源: {cors_origins}")
+
 
 # 定义请求模型
 class ImageGenerationRequest(BaseModel):
@@ -49,22 +511,252 @@ class ImageGenerationRequest(BaseModel):
     num_inference_steps: int = Field(50, ge=10, le=100, description="推理步数")
     max_sequence_length: int = Field(512, ge=128, le=1024, description="最大序列长度")
     seed: int = Field(0, description="随机种子")
+    format: Literal["webp", "jpeg", "png"] = Field(
+        "webp", description="输出图片格式"
+    )
+    quality: int = Field(92, ge=1, le=100, description="webp / jpeg 输出质量")
+
+
+# 输出图片格式对应的 MIME 类型
+IMAGE_MIME_TYPES = {
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
 
 
-def image_to_base64(image: Image.Image) -> str:
+def encode_image(
+    image: Image.Image, image_format: str = "webp", quality: int = 92
+) -> bytes:
+    """
+    将 PIL Image 编码为图片文件字节
+
+    Args:
+        image: PIL Image 对象
+        image_format: 输出图片格式（webp / jpeg / png）
+        quality: webp / jpeg 输出质量
+
+    Returns:
+        编码后的图片字节
+    """
+    buffered = io.BytesIO()
+    if image_format == "png":
+        # 最低压缩级别：编码速度远快于默认级别，体积略大
+        image.save(buffered, format="PNG", compress_level=1)
+    elif image_format == "webp":
+        image.save(buffered, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def image_to_base64(
+    image: Image.Image, image_format: str = "webp", quality: int = 92
+) -> str:
     """
     将 PIL Image 转换为 base64 编码的字符串
 
     Args:
         image: PIL Image 对象
+        image_format: 输出图片格式（webp / jpeg / png）
+        quality: webp / jpeg 输出质量
 
     Returns:
         base64 编码的图片字符串（包含 data URI 前缀）
     """
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+    img_str = base64.b64encode(encode_image(image, image_format, quality)).decode()
+    return f"data:{IMAGE_MIME_TYPES[image_format]};base64,{img_str}"
+
+
+def wants_binary(http_request: Request, response_format: str) -> bool:
+    """
+    判断客户端是否请求二进制图片响应
+
+    Args:
+        http_request: 原始 HTTP 请求
+        response_format: 查询参数 response_format（json / binary）
+
+    Returns:
+        ?response_format=binary 或 Accept 为 image/* / application/octet-stream 时返回 True
+    """
+    if response_format == "binary":
+        return True
+    accept = http_request.headers.get("accept", "")
+    return accept.startswith("image/") or accept.startswith("application/octet-stream")
+
+
+def binary_image_response(
+    image_bytes: bytes, image_format: str, metrics: dict
+) -> Response:
+    """
+    直接以二进制返回图片，省去 base64 膨胀和 JSON 序列化，指标放在响应头中
+
+    Args:
+        image_bytes: 编码后的图片字节
+        image_format: 图片格式（webp / jpeg / png）
+        metrics: 响应头指标，键名会加上 X- 前缀，例如 {"Inference-Time": 1.23}
+
+    Returns:
+        二进制图片响应
+    """
+    headers = {f"X-{name}": str(value) for name, value in metrics.items()}
+    return Response(
+        content=image_bytes,
+        media_type=IMAGE_MIME_TYPES[image_format],
+        headers=headers,
+    )
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def encode_prompt_cached(prompt: str, max_sequence_length: int):
+    """
+    缓存提示词的 T5 + CLIP 编码结果，相同提示词的重复请求只需执行 Transformer
+
+    Args:
+        prompt: 提示词
+        max_sequence_length: 最大序列长度
+
+    Returns:
+        (prompt_embeds, pooled_prompt_embeds)，均位于 GPU 上
+    """
+    prompt_embeds, pooled_prompt_embeds, _ = pipeline.encode_prompt(
+        prompt=prompt,
+        prompt_2=None,
+        max_sequence_length=max_sequence_length,
+    )
+    return prompt_embeds, pooled_prompt_embeds
+
+
+def generate_images(requests: List[ImageGenerationRequest]) -> List[Image.Image]:
+    """
+    将多个形状参数相同的请求合并为一次 pipeline 调用
+
+    Args:
+        requests: 图像生成请求列表（height/width/推理步数等参数必须一致）
+
+    Returns:
+        与请求一一对应的生成图片列表
+    """
+    first = requests[0]
+    with torch.inference_mode():
+        # 每个请求使用各自的随机种子，复用常驻的 CUDA 生成器
+        generators = [g.manual_seed(r.seed) for g, r in zip(cuda_generators, requests)]
+        try:
+            embeds = [
+                encode_prompt_cached(r.prompt, first.max_sequence_length)
+                for r in requests
+            ]
+            output = pipeline(
+                prompt_embeds=torch.cat([e[0] for e in embeds]),
+                pooled_prompt_embeds=torch.cat([e[1] for e in embeds]),
+                height=first.height,
+                width=first.width,
+                guidance_scale=first.guidance_scale,
+                num_inference_steps=first.num_inference_steps,
+                max_sequence_length=first.max_sequence_length,
+                generator=generators,
+            )
+        except torch.cuda.OutOfMemoryError:
+            # 只在显存不足时清空提示词缓存并归还显存，正常请求复用缓存分配器中的显存块
+            encode_prompt_cached.cache_clear()
+            torch.cuda.empty_cache()
+            raise
+    return output.images
+
+
+class DynBatcher:
+    """
+    动态批处理器
+
+    单一后台任务从队列中取出请求，在 max_delay 时间窗口内收集形状参数相同的请求，
+    合并为一次 pipeline 调用；形状参数不同的请求留在积压队列中，进入后续批次
+    """
+
+    def __init__(self, max_batch_size: int = 4, max_delay: float = 0.1):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task = None
+
+    @staticmethod
+    def batch_key(request: ImageGenerationRequest) -> tuple:
+        """只有这些参数完全相同的请求才能共享一次前向计算"""
+        return (
+            request.height,
+            request.width,
+            request.num_inference_steps,
+            request.guidance_scale,
+            request.max_sequence_length,
+        )
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, request: ImageGenerationRequest) -> Image.Image:
+        """提交请求并等待对应的生成结果"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        backlog = []
+        while True:
+            if not backlog:
+                backlog.append(await self.queue.get())
+
+            # 以积压队列中最早的请求为准，在时间窗口内凑齐同形状的请求
+            key = self.batch_key(backlog[0][0])
+            matched = sum(1 for r, _ in backlog if self.batch_key(r) == key)
+            deadline = loop.time() + self.max_delay
+            while matched < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                backlog.append(item)
+                if self.batch_key(item[0]) == key:
+                    matched += 1
+
+            batch, rest = [], []
+            for item in backlog:
+                if len(batch) < self.max_batch_size and self.batch_key(item[0]) == key:
+                    batch.append(item)
+                else:
+                    rest.append(item)
+            backlog = rest
+
+            await self._process(batch)
+
+    async def _process(self, batch):
+        logger.info(f"执行批次推理: 批大小={len(batch)}")
+        try:
+            # 在专用的 GPU 线程上执行推理，复用该线程上预热过的编译结果
+            images = await asyncio.get_running_loop().run_in_executor(
+                gpu_executor, generate_images, [r for r, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), image in zip(batch, images):
+            if not future.done():
+                future.set_result(image)
+
+
+batcher = DynBatcher(max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_BATCH_DELAY)
 
 
 @app.get("/health")
@@ -74,11 +766,17 @@ async def health():
 
 
 @app.post("/v1/images/generations")
-async def image_generation(request: ImageGenerationRequest):
+async def image_generation(
+    request: ImageGenerationRequest,
+    http_request: Request,
+    response_format: Literal["json", "binary"] = "json",
+):
     """
     图像生成 API 端点
 
-    根据文本提示词生成图片，返回生成的图片（base64 编码）
+    根据文本提示词生成图片，返回生成的图片（base64 编码）。
+    查询参数 response_format=binary 或请求头 Accept 为 image/* 时直接返回二进制图片，
+    计时信息放在 X-Inference-Time / X-Encoding-Time / X-Total-Time 响应头中
 
     请求体示例:
     {
@@ -88,7 +786,9 @@ async def image_generation(request: ImageGenerationRequest):
         "guidance_scale": 3.5,
         "num_inference_steps": 50,
         "max_sequence_length": 512,
-        "seed": 0
+        "seed": 0,
+        "format": "webp",
+        "quality": 92
     }
     """
     try:
@@ -104,28 +804,24 @@ async def image_generation(request: ImageGenerationRequest):
             f"随机种子={request.seed}"
         )
 
-        # 准备输入
-        generator = torch.Generator("cpu").manual_seed(request.seed)
-
-        # 执行推理并准确测量时间
+        # 提交到动态批处理器，与同形状的并发请求合并推理（含排队时间）
         inference_start_time = time.time()
-        with torch.inference_mode():
-            output = pipeline(
-                request.prompt,
-                height=request.height,
-                width=request.width,
-                guidance_scale=request.guidance_scale,
-                num_inference_steps=request.num_inference_steps,
-                max_sequence_length=request.max_sequence_length,
-                generator=generator,
-            )
-            output_image = output.images[0]
+        output_image = await batcher.submit(request)
         inference_end_time = time.time()
         inference_duration = inference_end_time - inference_start_time
 
-        # 转换为 base64
+        # 编码图片（二进制或 base64）
         base64_start_time = time.time()
-        output_base64 = image_to_base64(output_image)
+        binary = wants_binary(http_request, response_format)
+        # 图片编码是 CPU 密集操作，放到线程中执行，避免阻塞事件循环
+        if binary:
+            image_bytes = await asyncio.to_thread(
+                encode_image, output_image, request.format, request.quality
+            )
+        else:
+            output_base64 = await asyncio.to_thread(
+                image_to_base64, output_image, request.format, request.quality
+            )
         base64_duration = time.time() - base64_start_time
 
         logger.info(
@@ -134,6 +830,17 @@ async def image_generation(request: ImageGenerationRequest):
             f"总耗时: {inference_duration + base64_duration:.2f}秒"
         )
 
+        if binary:
+            return binary_image_response(
+                image_bytes,
+                request.format,
+                {
+                    "Inference-Time": round(inference_duration, 2),
+                    "Encoding-Time": round(base64_duration, 2),
+                    "Total-Time": round(inference_duration + base64_duration, 2),
+                },
+            )
+
         return JSONResponse(
             {
                 "status": "success",
@@ -156,7 +863,7 @@ async def image_generation(request: ImageGenerationRequest):
         raise HTTPException(status_code=500, detail=f"推理出错: {str(e)}")
 
 
-def inference(
+async def inference(
     prompt,
     height=1024,
     width=1024,
@@ -166,7 +873,7 @@ def inference(
     seed=0,
 ):
     """
-    执行图像生成推理
+    执行图像生成推理（Gradio 界面调用，与 API 请求共用动态批处理器）
 
     Args:
         prompt: 提示词
@@ -193,22 +900,19 @@ def inference(
             f"随机种子={seed}"
         )
 
-        # 准备生成器
-        generator = torch.Generator("cpu").manual_seed(seed)
+        request = ImageGenerationRequest(
+            prompt=prompt,
+            height=int(height),
+            width=int(width),
+            guidance_scale=guidance_scale,
+            num_inference_steps=int(num_inference_steps),
+            max_sequence_length=int(max_sequence_length),
+            seed=int(seed),
+        )
 
-        # 执行推理并准确测量时间
+        # 执行推理并准确测量时间（含排队时间）
         inference_start_time = time.time()
-        with torch.inference_mode():
-            output = pipeline(
-                prompt,
-                height=height,
-                width=width,
-                guidance_scale=guidance_scale,
-                num_inference_steps=int(num_inference_steps),
-                max_sequence_length=max_sequence_length,
-                generator=generator,
-            )
-            output_image = output.images[0]
+        output_image = await batcher.submit(request)
         inference_end_time = time.time()
         inference_duration = inference_end_time - inference_start_time
 
@@ -318,29 +1022,18 @@ with gr.Blocks(title="FLUX.1-dev") as demo:
     )
 
 
+# 将 Gradio 界面挂载到 FastAPI 应用的根路径：API 与界面共用同一端口和事件循环，
+# Gradio 的推理请求与 API 请求进入同一个后台推理队列
+app = gr.mount_gradio_app(app, demo, path="/")
+
+
 if __name__ == "__main__":
     import uvicorn
-    import threading
 
     # 获取配置
     host = os.getenv("GRADIO_HOST", "0.0.0.0")
 
-    # Gradio 端口
-    gradio_port_env = os.getenv("GRADIO_PORT")
-    if gradio_port_env:
-        try:
-            gradio_port = int(gradio_port_env)
-            logger.info(f"从环境变量 GRADIO_PORT 获取端口: {gradio_port}")
-        except ValueError:
-            logger.warning(
-                f"环境变量 GRADIO_PORT 的值 '{gradio_port_env}' 不是有效数字，使用默认端口 8099"
-            )
-            gradio_port = 8099
-    else:
-        gradio_port = 8099
-        logger.info(f"环境变量 GRADIO_PORT 未设置，使用默认端口: {gradio_port}")
-
-    # API 端口（默认比 Gradio 端口大 1）
+    # 服务端口（API 与 Gradio 界面共用）
     api_port_env = os.getenv("API_PORT")
     if api_port_env:
         try:
@@ -348,29 +1041,16 @@ if __name__ == "__main__":
             logger.info(f"从环境变量 API_PORT 获取端口: {api_port}")
         except ValueError:
             logger.warning(
-                f"环境变量 API_PORT 的值 '{api_port_env}' "
-                f"不是有效数字，使用默认端口 {gradio_port + 1}"
+                f"环境变量 API_PORT 的值 '{api_port_env}' 不是有效数字，使用默认端口 8100"
             )
-            api_port = gradio_port + 1
+            api_port = 8100
     else:
-        api_port = gradio_port + 1
+        api_port = 8100
         logger.info(f"环境变量 API_PORT 未设置，使用默认端口: {api_port}")
 
-    # 在后台线程启动 Gradio
-    def run_gradio():
-        logger.info(f"正在启动 Gradio 服务器，地址: http://{host}:{gradio_port}")
-        demo.launch(
-            server_name=host,
-            server_port=gradio_port,
-            share=False,
-        )
-
-    gradio_thread = threading.Thread(target=run_gradio, daemon=True)
-    gradio_thread.start()
-
     # 启动 FastAPI 服务器
     logger.info(f"正在启动 FastAPI 服务器，地址: http://{host}:{api_port}")
     logger.info(f"API 文档地址: http://{host}:{api_port}/docs")
-    logger.info(f"Gradio 界面地址: http://{host}:{gradio_port}")
+    logger.info(f"Gradio 界面地址: http://{host}:{api_port}/")
 
     uvicorn.run(app, host=host, port=api_port, log_level="info")
@@ -3,12 +3,120 @@
 测试脚本：用于测试 FLUX.1-dev /v1/images/generations 接口
 """
 
+import os
 import sys
-import base64
+import json
+import asyncio
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
 import time
-from typing import Optional
+from typing import List, Optional
+
+try:
+    # pybase64 使用 SIMD（SSSE3 / AVX2 / NEON）加速 base64 编解码，接口与标准库一致
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+try:
+    # orjson 使用 SIMD 扫描需要转义的字符，序列化 / 解析数 MB 的 base64 字符串远快于标准库 json
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(obj) -> bytes:
+    """
+    将对象序列化为 UTF-8 编码的 JSON 字节（优先使用 orjson）
+
+    Args:
+        obj: 待序列化的对象
+
+    Returns:
+        JSON 字节
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def json_loads(data: bytes):
+    """
+    解析 JSON 字节（优先使用 orjson）
+
+    Args:
+        data: JSON 字节
+
+    Returns:
+        解析后的对象
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# 模块级会话：复用 TCP 连接（HTTP keep-alive），循环调用时省去每次请求的握手开销
+_SESSION = requests.Session()
+# urllib3 默认已设置 TCP_NODELAY；不设置 SO_SNDBUF，显式设置会关闭 Linux 的发送缓冲区自动调节，
+# 且被 net.core.wmem_max 截断，通常反而比自动调节的缓冲区小
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.headers["Connection"] = "keep-alive"
+# base64 / 图片数据几乎不可压缩，不请求 gzip，省去两端的压缩与解压开销
+_SESSION.headers["Accept-Encoding"] = "identity"
+
+# 二进制响应流式写入文件时的块大小
+STREAM_CHUNK_SIZE = 1 << 20
+
+# 错误响应最多读取的字节数
+ERROR_DETAIL_LIMIT = 4096
+
+
+def error_detail(response, limit: int = ERROR_DETAIL_LIMIT):
+    """
+    读取错误响应的详情，最多读取 limit 字节，避免服务端回显大请求体时占用大量内存
+
+    Args:
+        response: requests.Response 对象（stream=True，响应体尚未读取）
+        limit: 最多读取的字节数
+
+    Returns:
+        解析后的 JSON 对象；无法解析时为截断后的文本
+    """
+    try:
+        blob = response.raw.read(limit, decode_content=True)
+    finally:
+        response.close()
+    try:
+        return json_loads(blob)
+    except Exception:
+        return blob.decode("utf-8", "replace")
+
+
+def write_file(output_path: str, data: bytes):
+    """
+    用 os.open + os.write 直接写入文件，跳过 Python 缓冲写入层
+
+    Args:
+        output_path: 输出文件路径
+        data: 文件内容
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(output_path, flags, 0o644)
+    try:
+        # 按最终大小预先分配磁盘空间，避免边写边扩展文件（文件系统不支持时忽略）
+        if data and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, len(data))
+            except OSError:
+                pass
+        with memoryview(data) as view:
+            written = 0
+            while written < len(view):
+                written += os.write(fd, view[written:])
+    finally:
+        os.close(fd)
 
 
 def base64_to_image_file(base64_str: str, output_path: str):
@@ -19,13 +127,44 @@ def base64_to_image_file(base64_str: str, output_path: str):
         base64_str: base64 编码的图片字符串（可以包含或不包含 data URI 前缀）
         output_path: 输出文件路径
     """
-    # 移除 data URI 前缀（如果存在）
-    if "," in base64_str:
-        base64_str = base64_str.split(",")[1]
+    # 移除 data URI 前缀（如果存在）；逗号只会出现在开头的短前缀中，限定查找范围，
+    # 不再对整个（可能数十 MB 的）字符串做 in + split 两次完整扫描
+    if base64_str.startswith("data:"):
+        base64_str = base64_str[base64_str.find(",", 0, 64) + 1 :]
+
+    # 服务端返回的数据可信，跳过逐字符校验
+    write_file(output_path, base64.b64decode(base64_str, validate=False))
+
+
+def mime_extension(mime_type: str) -> str:
+    """
+    根据图片 MIME 类型确定扩展名
 
-    img_data = base64.b64decode(base64_str)
-    with open(output_path, "wb") as f:
-        f.write(img_data)
+    Args:
+        mime_type: MIME 类型（例如 image/webp，可以带 ; 参数）
+
+    Returns:
+        图片扩展名（无法识别时为 .png）
+    """
+    if mime_type.startswith("image/"):
+        subtype = mime_type[len("image/") :].split(";", 1)[0].strip()
+        return ".jpg" if subtype == "jpeg" else f".{subtype}"
+    return ".png"
+
+
+def image_extension(base64_str: str) -> str:
+    """
+    根据 data URI 前缀中的 MIME 类型确定图片扩展名
+
+    Args:
+        base64_str: base64 编码的图片字符串（可以包含或不包含 data URI 前缀）
+
+    Returns:
+        图片扩展名（无法识别时为 .png）
+    """
+    if base64_str.startswith("data:"):
+        return mime_extension(base64_str[len("data:") : base64_str.find(";", 0, 64)])
+    return ".png"
 
 
 def test_image_generation(
@@ -37,7 +176,9 @@ def test_image_generation(
     num_inference_steps: int = 50,
     max_sequence_length: int = 512,
     seed: int = 0,
+    image_format: str = "webp",
     output_path: Optional[str] = None,
+    binary: bool = False,
 ):
     """
     测试图像生成 API
@@ -51,7 +192,10 @@ def test_image_generation(
         num_inference_steps: 推理步数
         max_sequence_length: 最大序列长度
         seed: 随机种子
+        image_format: 输出图片格式（webp / jpeg / png）
         output_path: 输出图片保存路径（如果为 None，则自动生成）
+        binary: 是否请求二进制图片响应（Accept: application/octet-stream），
+            响应体直接写入文件，省去 base64 解码
 
     Returns:
         响应数据（字典）
@@ -65,6 +209,7 @@ def test_image_generation(
         "num_inference_steps": num_inference_steps,
         "max_sequence_length": max_sequence_length,
         "seed": seed,
+        "format": image_format,
     }
 
     print(f"\n正在发送请求到: {api_url}")
@@ -80,10 +225,47 @@ def test_image_generation(
 
     # 发送 POST 请求
     try:
-        response = requests.post(api_url, json=request_data, timeout=300)
+        # 预先序列化为字节发送，避免 requests 内部再用标准库 json.dumps 序列化一次
+        headers = {"Content-Type": "application/json"}
+        if binary:
+            # 请求二进制响应时服务端直接返回图片字节，不再经过 base64 + JSON
+            headers["Accept"] = "application/octet-stream"
+        response = _SESSION.post(
+            api_url,
+            data=json_dumps(request_data),
+            headers=headers,
+            stream=True,
+            timeout=300,
+        )
         response.raise_for_status()
 
-        result = response.json()
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith("image/"):
+            # 如果没有指定输出路径，自动生成
+            if output_path is None:
+                timestamp = int(time.time())
+                output_path = f"flux_output_{timestamp}{mime_extension(content_type)}"
+
+            # 流式写入文件，不在内存中缓存整个响应体
+            with open(output_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+
+            result = {
+                "status": "success",
+                "message": "推理完成！",
+                "result": {"path": output_path},
+            }
+            print("\n✓ 请求成功！")
+            print(f"  {result['message']}")
+            print(
+                f"  推理耗时: {response.headers.get('X-Inference-Time')}s, "
+                f"编码耗时: {response.headers.get('X-Encoding-Time')}s"
+            )
+            print(f"  ✓ 结果图片已保存到: {output_path}")
+            return result
+
+        result = json_loads(response.content)
 
         if result.get("status") == "success":
             print("\n✓ 请求成功！")
@@ -96,7 +278,8 @@ def test_image_generation(
                 # 如果没有指定输出路径，自动生成
                 if output_path is None:
                     timestamp = int(time.time())
-                    output_path = f"flux_output_{timestamp}.png"
+                    ext = image_extension(output_image_base64)
+                    output_path = f"flux_output_{timestamp}{ext}"
 
                 base64_to_image_file(output_image_base64, output_path)
                 print(f"  ✓ 结果图片已保存到: {output_path}")
@@ -113,18 +296,84 @@ def test_image_generation(
     except requests.exceptions.HTTPError as e:
         print(f"\n✗ HTTP 错误: {e}")
         if e.response is not None:
-            try:
-                error_detail = e.response.json()
-                print(f"  错误详情: {error_detail}")
-            except Exception:
-                print(f"  响应内容: {e.response.text}")
+            print(f"  错误详情: {error_detail(e.response)}")
         raise
     except requests.exceptions.RequestException as e:
         print(f"\n✗ 请求异常: {e}")
         raise
 
 
-def main():
+async def test_image_generation_async(**kwargs):
+    """
+    test_image_generation 的异步版本：在线程池中执行请求，不阻塞事件循环
+
+    Args:
+        **kwargs: 传给 test_image_generation 的参数
+
+    Returns:
+        响应数据（字典）
+    """
+    return await asyncio.to_thread(test_image_generation, **kwargs)
+
+
+async def run_concurrent(cases: List[dict], concurrency: int = 4) -> list:
+    """
+    在一个事件循环中并发执行多个图像生成请求（例如测试服务端动态批处理的吞吐）
+
+    Args:
+        cases: 每个请求的 test_image_generation 参数
+        concurrency: 最大并发请求数
+
+    Returns:
+        与 cases 顺序一致的结果列表，失败的请求对应异常对象
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(case: dict):
+        async with semaphore:
+            return await test_image_generation_async(**case)
+
+    start_time = time.time()
+    results = await asyncio.gather(
+        *[run(case) for case in cases], return_exceptions=True
+    )
+    duration = time.time() - start_time
+
+    succeeded = sum(1 for r in results if not isinstance(r, Exception))
+    print(
+        f"\n共 {len(cases)} 个请求，成功 {succeeded} 个，总耗时 {duration:.2f}s，"
+        f"吞吐 {succeeded / duration:.3f} 张/s"
+    )
+    return results
+
+
+def positive_int(value: str) -> int:
+    """
+    argparse 类型函数：解析大于等于 1 的整数
+
+    Args:
+        value: 命令行参数字符串
+
+    Returns:
+        解析后的整数
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必须是大于等于 1 的整数: {value}")
+    return number
+
+
+# 命令行解析器，首次调用 main 时构建，之后复用
+_parser: Optional[argparse.ArgumentParser] = None
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    """
+    构建命令行参数解析器
+
+    Returns:
+        argparse.ArgumentParser 对象
+    """
     parser = argparse.ArgumentParser(
         description="测试 FLUX.1-dev API",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -144,6 +393,11 @@ def main():
                  --max-sequence-length 512 \\
                  --seed 42 \\
                  --output result.png
+
+  # 并发发送 8 个请求（随机种子 0~7），最多 4 个同时进行，服务端会动态合批
+  python test.py --api-url http://localhost:8100/v1/images/generations \
+                 --prompt "A cat holding a sign that says hello world" \
+                 --repeat 8 --concurrency 4
         """,
     )
 
@@ -195,27 +449,86 @@ def main():
         default=0,
         help="随机种子（默认：0）",
     )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["webp", "jpeg", "png"],
+        default="webp",
+        help="输出图片格式（默认：webp）",
+    )
     parser.add_argument(
         "--output",
         type=str,
         default=None,
         help="输出图片保存路径（默认：自动生成）",
     )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="请求二进制图片响应，直接写入文件（不经过 base64 / JSON）",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=positive_int,
+        default=1,
+        help="请求次数，随机种子依次递增，结果文件名带上种子（默认：1）",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=positive_int,
+        default=4,
+        help="--repeat 大于 1 时的最大并发请求数（默认：4）",
+    )
+
+    return parser
+
 
-    args = parser.parse_args()
+def main(argv: Optional[List[str]] = None):
+    """
+    命令行入口
+
+    Args:
+        argv: 命令行参数（为 None 时使用 sys.argv[1:]）
+
+    Returns:
+        进程退出码
+    """
+    global _parser
+    if _parser is None:
+        _parser = _build_parser()
+    args = _parser.parse_args(argv)
+
+    case = {
+        "api_url": args.api_url,
+        "prompt": args.prompt,
+        "height": args.height,
+        "width": args.width,
+        "guidance_scale": args.guidance_scale,
+        "num_inference_steps": args.num_inference_steps,
+        "max_sequence_length": args.max_sequence_length,
+        "seed": args.seed,
+        "image_format": args.format,
+        "output_path": args.output,
+        "binary": args.binary,
+    }
 
     try:
-        test_image_generation(
-            api_url=args.api_url,
-            prompt=args.prompt,
-            height=args.height,
-            width=args.width,
-            guidance_scale=args.guidance_scale,
-            num_inference_steps=args.num_inference_steps,
-            max_sequence_length=args.max_sequence_length,
-            seed=args.seed,
-            output_path=args.output,
-        )
+        if args.repeat > 1:
+            if args.output is not None:
+                root, ext = os.path.splitext(args.output)
+            else:
+                root = f"flux_output_{int(time.time())}"
+                ext = mime_extension("image/" + args.format)
+            cases = [
+                {**case, "seed": seed, "output_path": f"{root}_{seed}{ext}"}
+                for seed in range(args.seed, args.seed + args.repeat)
+            ]
+            results = asyncio.run(run_concurrent(cases, args.concurrency))
+            if any(isinstance(r, Exception) for r in results):
+                print("\n测试失败: 部分请求出错", file=sys.stderr)
+                return 1
+        else:
+            test_image_generation(**case)
         print("\n测试完成！")
         return 0
     except Exception as e:
@@ -1,88 +1,587 @@
 import os
+
+# inductor 编译缓存放在应用目录下，容器重启后可直接复用（需在 import torch 之前设置）
+os.environ.setdefault(
+    "TORCHINDUCTOR_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".torchinductor_cache"),
+)
+# CUDA 缓存分配器：可扩展显存段减少碎片，大块显存不再拆分（需在 import torch 之前设置）
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+)
+
 import io
-import base64
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import torch
 from PIL import Image
 import gradio as gr
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
+from diffusers import QwenImageTransformer2DModel
 from modelscope import QwenImageEditPlusPipeline
 from loguru import logger
-from typing import List, Optional
+from typing import List, Literal, Optional
+
+try:
+    # pybase64 使用 SIMD（SSSE3 / AVX2 / NEON）加速 base64 编解码，接口与标准库一致
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+try:
+    import orjson  # noqa: F401
+
+    # orjson 序列化数 MB 的 base64 字符串远快于标准库 json
+    from fastapi.responses import ORJSONResponse as JSONResponse
+except ImportError:
+    from fastapi.responses import JSONResponse
+
+if hasattr(base64, "get_version"):
+    logger.info(f"base64 后端: pybase64 {base64.get_version()}")
+else:
+    logger.info("未安装 pybase64，使用标准库 base64")
+
+# 纯推理服务：允许 TF32 矩阵乘并开启 cuDNN 卷积算法自动选择。
+# 梯度模式是线程局部的，推理都在 GPU 线程上执行，因此不在导入时全局关闭 autograd，
+# 而是依赖每次调用的 torch.inference_mode() 和加载后对参数的 requires_grad_(False)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+# Transformer 量化方式：auto / fp8 / nvfp4 / none
+# auto 在支持 FP8 的显卡（算力 >= 8.9，即 Ada / Hopper 及以上）上使用 FP8，否则保持 bf16
+TRANSFORMER_QUANT = os.getenv("TRANSFORMER_QUANT", "auto").lower()
+
+# Qwen-Image-Edit-2509 会把输入图片缩放到约 1024x1024 的像素面积后再送入 VAE
+INPUT_TARGET_PIXELS = 1024 * 1024
+
+# 量化时保持 bf16 的顶层模块：输入嵌入、时间嵌入和输出层，对精度敏感且只占很小的权重比例。
+# 各 block 内的调制线性层（img_mod / txt_mod，输出宽 18432）约占 Transformer 权重的 30%，
+# 正常参与量化。名字只匹配顶层模块，不会命中 block 内的同名子模块
+QUANT_SKIP_MODULES = [
+    "img_in",
+    "txt_in",
+    "txt_norm",
+    "time_text_embed",
+    "norm_out",
+    "proj_out",
+]
+
+
+# CublasLinear（fp16 累加）替换时额外跳过的调制线性层，按任意层级的模块名匹配：
+# 各 block 的 img_mod / txt_mod。调制输出的 shift / scale / gate 直接缩放整个残差流，
+# 对 fp16 累加误差敏感。与量化跳过列表相互独立
+CUBLAS_SKIP_MODULES = ["img_mod", "txt_mod"]
+
+
+def is_quant_skipped(name: str) -> bool:
+    """
+    判断模块 / 参数是否属于 QUANT_SKIP_MODULES 中的顶层模块
+
+    Args:
+        name: 模块或参数的完整名称（如 proj_out.weight）
+
+    Returns:
+        属于跳过量化的顶层模块时返回 True
+    """
+    return name.split(".", 1)[0] in QUANT_SKIP_MODULES
+
+
+def is_cublas_skipped(name: str) -> bool:
+    """
+    判断线性层是否应保留为 nn.Linear，不替换为 CublasLinear
+
+    Args:
+        name: 线性层的完整名称（如 transformer_blocks.0.norm1.linear）
+
+    Returns:
+        属于跳过量化的顶层模块，或位于任意层级的调制线性层之内时返回 True
+    """
+    if is_quant_skipped(name):
+        return True
+    return any(part in CUBLAS_SKIP_MODULES for part in name.split("."))
+
+
+def quant_skip_param_names(model_path: str) -> List[str]:
+    """
+    列出 QUANT_SKIP_MODULES 中顶层模块的完整参数名
+
+    diffusers 的 torchao 量化器按 `key + "."` 子串（或与参数名完全相等）匹配 modules_to_not_convert，
+    裸模块名会同时命中 block 内的同名子模块；传入完整参数名则只会精确匹配顶层模块。
+    模型在 meta 设备上按配置实例化，不加载权重
+
+    Args:
+        model_path: 模型目录
+
+    Returns:
+        参数名列表
+    """
+    from accelerate import init_empty_weights
+
+    config = QwenImageTransformer2DModel.load_config(
+        model_path, subfolder="transformer"
+    )
+    with init_empty_weights():
+        model = QwenImageTransformer2DModel.from_config(config)
+    return [name for name, _ in model.named_parameters() if is_quant_skipped(name)]
+
+
+def build_quantization_config(model_path: str):
+    """
+    根据 TRANSFORMER_QUANT 环境变量构建 Transformer 的量化配置
+
+    Args:
+        model_path: 模型目录
+
+    Returns:
+        diffusers 量化配置对象，不量化时返回 None
+    """
+    quant = TRANSFORMER_QUANT
+    if quant == "auto":
+        quant = "fp8" if torch.cuda.get_device_capability() >= (8, 9) else "none"
+    logger.info(f"Transformer 量化方式: {quant}")
+
+    if quant == "none":
+        return None
+    if quant == "fp8":
+        from diffusers import TorchAoConfig
+
+        # FP8 动态激活 + 按行缩放的权重量化（torchao）
+        return TorchAoConfig(
+            "float8dq_e4m3_row",
+            modules_to_not_convert=quant_skip_param_names(model_path),
+        )
+    if quant == "nvfp4":
+        from diffusers import NVIDIAModelOptConfig
+
+        # NVFP4 需要 Blackwell 显卡以及 nvidia-modelopt
+        config = NVIDIAModelOptConfig(quant_type="NVFP4")
+        # diffusers 会把 modules_to_not_convert 转成 "*name*" 通配符，同样会命中 block 内的同名子模块，
+        # 因此直接写入以顶层模块名开头的通配符，关闭对应的量化器
+        for name in QUANT_SKIP_MODULES:
+            config.modelopt_config["quant_cfg"][f"{name}.*"] = {"enable": False}
+        return config
+    raise ValueError(
+        f"不支持的 TRANSFORMER_QUANT: {TRANSFORMER_QUANT}，可选值: auto / fp8 / nvfp4 / none"
+    )
+
+
+class HalfCublasLinear(torch.nn.Module):
+    """使用 fp16 累加 cuBLAS GEMM 的线性层，输入输出保持原 dtype"""
+
+    def __init__(self, linear: torch.nn.Linear):
+        super().__init__()
+        from cublas_ops import CublasLinear
+
+        self.linear = CublasLinear(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            device=linear.weight.device,
+            dtype=torch.float16,
+        )
+        with torch.no_grad():
+            self.linear.weight.copy_(linear.weight.half())
+            if linear.bias is not None:
+                self.linear.bias.copy_(linear.bias.half())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.linear(x.half()).to(x.dtype)
+
+
+def replace_linear_with_cublas(model: torch.nn.Module) -> int:
+    """
+    将模型中的 nn.Linear 替换为 HalfCublasLinear（跳过 is_cublas_skipped 命中的线性层）
+
+    Args:
+        model: 待替换的模型
+
+    Returns:
+        被替换的线性层数量
+    """
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            full_name = f"{name}.{child_name}" if name else child_name
+            if not isinstance(child, torch.nn.Linear):
+                continue
+            if is_cublas_skipped(full_name):
+                continue
+            setattr(module, child_name, HalfCublasLinear(child))
+            replaced += 1
+    return replaced
+
 
 # 全局加载 pipeline
 logger.info("正在加载 pipeline...")
+model_path = "/models/Qwen-Image-Edit-2509"
+quantization_config = build_quantization_config(model_path)
+transformer = QwenImageTransformer2DModel.from_pretrained(
+    model_path,
+    subfolder="transformer",
+    quantization_config=quantization_config,
+    torch_dtype=torch.bfloat16,
+)
 pipeline = QwenImageEditPlusPipeline.from_pretrained(
-    "/models/Qwen-Image-Edit-2509", torch_dtype=torch.bfloat16
+    model_path, transformer=transformer, torch_dtype=torch.bfloat16
 )
 logger.info("pipeline 加载完成")
 
 pipeline.to("cuda:0")
 pipeline.set_progress_bar_config(disable=None)
 
+# VAE 分块 / 分片解码：大分辨率解码时显著降低峰值显存
+pipeline.vae.enable_tiling()
+pipeline.vae.enable_slicing()
+
+# 冻结所有组件的参数，避免 diffusers 内部的 requires_grad 检查和梯度相关开销
+for component in pipeline.components.values():
+    if isinstance(component, torch.nn.Module):
+        component.requires_grad_(False)
+
+# 消费级显卡（Ampere / Ada）上 fp16 累加的矩阵乘吞吐约为 fp32 累加的 2 倍，
+# 设置 CUBLAS_HGEMM=1 后使用 torch-cublas-hgemm 的 CublasLinear 替换 Transformer 线性层
+cublas_swapped = False
+if os.getenv("CUBLAS_HGEMM", "0") == "1":
+    if quantization_config is not None:
+        logger.warning("Transformer 已量化，跳过 CublasLinear 替换")
+    elif torch.cuda.get_device_capability() >= (9, 0):
+        logger.info("当前显卡 bf16 矩阵乘已可达峰值，跳过 CublasLinear 替换")
+    else:
+        replaced = replace_linear_with_cublas(pipeline.transformer)
+        logger.info(f"已将 {replaced} 个线性层替换为 CublasLinear")
+        cublas_swapped = replaced > 0
+
+# CublasLinear 调用 pybind11 扩展，Dynamo 无法追踪（fullgraph 下直接报错，
+# 否则每个线性层处都会断图，编译收益全部丢失），因此替换后不再编译
+torch_compile = os.getenv("TORCH_COMPILE", "1") == "1"
+if torch_compile and cublas_swapped:
+    logger.warning("CublasLinear 无法被 torch.compile 追踪，跳过编译")
+    torch_compile = False
+
+# 所有 GPU 工作（编译预热和推理）都在这一个专用线程上执行：
+# 编译产生的按线程状态只有在同一线程上预热才能被推理复用；
+# 单线程同时保证同一时刻只有一次 pipeline 调用占用 GPU
+gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+
+
+def run_pipeline(inputs: dict) -> Image.Image:
+    """
+    执行一次 pipeline 推理（只在 GPU 线程上调用）
+
+    Args:
+        inputs: pipeline 的输入参数
+
+    Returns:
+        生成的图片
+    """
+    with torch.inference_mode():
+        try:
+            output = pipeline(**inputs)
+        except torch.cuda.OutOfMemoryError:
+            # 只在显存不足时归还缓存，正常请求复用缓存分配器中的显存块
+            torch.cuda.empty_cache()
+            raise
+    return output.images[0]
+
+
+# 编译 Transformer 和 VAE 解码器（TORCH_COMPILE=0 可关闭）。
+# 输入图片的数量和尺寸随请求变化，因此使用动态形状；启动时用一张 1024x1024 空白图预热。
+# 提示词长度和图片尺寸几乎每次请求都不同，inductor 的 CUDA Graph 会为每个新形状重新录制并占用
+# 额外的显存池，因此使用不带 CUDA Graph 的 max-autotune
+if torch_compile:
+    pipeline.transformer.compile(mode="max-autotune-no-cudagraphs", dynamic=True)
+    pipeline.vae.decode = torch.compile(
+        pipeline.vae.decode, mode="max-autotune-no-cudagraphs"
+    )
+
+    logger.info("正在预热编译（1024x1024）...")
+    gpu_executor.submit(
+        run_pipeline,
+        {
+            "image": [Image.new("RGB", (1024, 1024))],
+            "prompt": "warmup",
+            "negative_prompt": " ",
+            "true_cfg_scale": 4.0,
+            "num_inference_steps": 2,
+        },
+    ).result()
+    logger.info("编译预热完成")
+
+
+async def server_loop(queue: asyncio.Queue):
+    """
+    单一后台推理任务：按顺序从队列中取出任务执行推理，并把结果放回各自的响应队列
+
+    Args:
+        queue: 任务队列，元素为 (pipeline 输入参数, 响应队列)
+    """
+    while True:
+        inputs, response_q = await queue.get()
+        try:
+            # 在专用的 GPU 线程上执行阻塞的推理，保持事件循环可响应
+            result = await asyncio.get_running_loop().run_in_executor(
+                gpu_executor, run_pipeline, inputs
+            )
+        except Exception as e:
+            result = e
+        await response_q.put(result)
+
+
+async def submit_job(inputs: dict) -> Image.Image:
+    """
+    提交推理任务到后台队列并等待结果
+
+    Args:
+        inputs: pipeline 的输入参数
+
+    Returns:
+        生成的图片
+    """
+    response_q = asyncio.Queue(maxsize=1)
+    await app.state.model_queue.put((inputs, response_q))
+    result = await response_q.get()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：创建任务队列并启动后台推理任务"""
+    app.state.model_queue = asyncio.Queue()
+    task = asyncio.create_task(server_loop(app.state.model_queue))
+    yield
+    task.cancel()
+
+
 # 创建 FastAPI 应用
-app = FastAPI(title="Qwen Image Edit Plus API", version="1.0.0")
-
-# 配置 CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+app = FastAPI(
+    title="Qwen Image Edit Plus API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=JSONResponse,
 )
 
+# 配置 CORS（仅在设置 ENABLE_CORS=1 时启用，同源访问或内网调用无需 CORS 中间件）
+if os.getenv("ENABLE_CORS", "0") == "1":
+    # 允许的来源，多个用逗号分隔
+    cors_origins = [
+        origin.strip()
+        for origin in os.getenv("CORS_ALLOW_ORIGINS", "*").split(",")
+        if origin.strip()
+    ]
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=cors_origins,
+        # 规范不允许通配来源携带凭据
+        allow_credentials=cors_origins != ["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    logger.info(f"已启用 CORS，允许的来源: {cors_origins}")
+
 
 # 定义请求模型
-class ImageEditRequest(BaseModel):
-    """图像编辑请求模型"""
+class ImageEditParams(BaseModel):
+    """图像编辑参数模型（不含输入图片）"""
 
-    images: List[str] = Field(
-        ...,
-        description="base64 编码的图片列表（支持多张），可以包含或不包含 data URI 前缀",
-        min_items=1,
-    )
     prompt: str = Field(..., description="提示词", min_length=1)
     negative_prompt: Optional[str] = Field(" ", description="负面提示词")
     num_inference_steps: int = Field(40, ge=10, le=100, description="推理步数")
     guidance_scale: float = Field(1.0, ge=0.0, le=10.0, description="引导比例")
     true_cfg_scale: float = Field(4.0, ge=0.0, le=10.0, description="真实 CFG 比例")
     seed: int = Field(0, description="随机种子")
+    format: Literal["webp", "jpeg", "png"] = Field(
+        "webp", description="输出图片格式"
+    )
+    quality: int = Field(92, ge=1, le=100, description="webp / jpeg 输出质量")
+
+
+class ImageEditRequest(ImageEditParams):
+    """图像编辑请求模型"""
+
+    images: List[str] = Field(
+        ...,
+        description="base64 编码的图片列表（支持多张），可以包含或不包含 data URI 前缀",
+        min_items=1,
+    )
+
+
+class ImageEditLocalRequest(ImageEditParams):
+    """图像编辑请求模型（服务端本地文件路径）"""
+
+    image_paths: List[str] = Field(
+        ..., description="服务端本地图片文件路径列表（支持多张）", min_items=1
+    )
+    output_path: Optional[str] = Field(
+        None, description="结果图片的服务端保存路径（为空时按常规方式返回图片）"
+    )
+
+
+# 输出图片格式对应的 MIME 类型
+IMAGE_MIME_TYPES = {
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+
+def save_image(image: Image.Image, fp, image_format: str = "webp", quality: int = 92):
+    """
+    按输出格式保存 PIL Image
+
+    Args:
+        image: PIL Image 对象
+        fp: 文件路径或文件对象
+        image_format: 输出图片格式（webp / jpeg / png）
+        quality: webp / jpeg 输出质量
+    """
+    if image_format == "png":
+        # 最低压缩级别：编码速度远快于默认级别，体积略大
+        image.save(fp, format="PNG", compress_level=1)
+    elif image_format == "webp":
+        image.save(fp, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(fp, format="JPEG", quality=quality)
 
 
-def image_to_base64(image: Image.Image) -> str:
+def encode_image(
+    image: Image.Image, image_format: str = "webp", quality: int = 92
+) -> bytes:
+    """
+    将 PIL Image 编码为图片文件字节
+
+    Args:
+        image: PIL Image 对象
+        image_format: 输出图片格式（webp / jpeg / png）
+        quality: webp / jpeg 输出质量
+
+    Returns:
+        编码后的图片字节
+    """
+    buffered = io.BytesIO()
+    save_image(image, buffered, image_format, quality)
+    return buffered.getvalue()
+
+
+def image_to_base64(
+    image: Image.Image, image_format: str = "webp", quality: int = 92
+) -> str:
     """
     将 PIL Image 转换为 base64 编码的字符串
 
     Args:
         image: PIL Image 对象
+        image_format: 输出图片格式（webp / jpeg / png）
+        quality: webp / jpeg 输出质量
 
     Returns:
         base64 编码的图片字符串（包含 data URI 前缀）
     """
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+    img_str = base64.b64encode(encode_image(image, image_format, quality)).decode()
+    return f"data:{IMAGE_MIME_TYPES[image_format]};base64,{img_str}"
+
+
+def wants_binary(http_request: Request, response_format: str) -> bool:
+    """
+    判断客户端是否请求二进制图片响应
+
+    Args:
+        http_request: 原始 HTTP 请求
+        response_format: 查询参数 response_format（json / binary）
+
+    Returns:
+        ?response_format=binary 或 Accept 为 image/* / application/octet-stream 时返回 True
+    """
+    if response_format == "binary":
+        return True
+    accept = http_request.headers.get("accept", "")
+    return accept.startswith("image/") or accept.startswith("application/octet-stream")
+
+
+def binary_image_response(
+    image_bytes: bytes, image_format: str, metrics: dict
+) -> Response:
+    """
+    直接以二进制返回图片，省去 base64 膨胀和 JSON 序列化，指标放在响应头中
+
+    Args:
+        image_bytes: 编码后的图片字节
+        image_format: 图片格式（webp / jpeg / png）
+        metrics: 响应头指标，键名会加上 X- 前缀，例如 {"Inference-Time": 1.23}
+
+    Returns:
+        二进制图片响应
+    """
+    headers = {f"X-{name}": str(value) for name, value in metrics.items()}
+    return Response(
+        content=image_bytes,
+        media_type=IMAGE_MIME_TYPES[image_format],
+        headers=headers,
+    )
 
 
 def base64_to_image(base64_str: str) -> Image.Image:
     """
-    将 base64 编码的字符串转换为 PIL Image
+    将 base64 编码的字符串转换为 RGB 模式的 PIL Image
 
     Args:
         base64_str: base64 编码的图片字符串（可以包含或不包含 data URI 前缀）
 
     Returns:
-        PIL Image 对象
+        RGB 模式的 PIL Image 对象
+    """
+    # 移除 data URI 前缀（如果存在）；逗号只会出现在开头的短前缀中，限定查找范围，
+    # 不再对整个（可能数十 MB 的）字符串做 in + split 两次完整扫描
+    if base64_str.startswith("data:"):
+        base64_str = base64_str[base64_str.find(",", 0, 256) + 1 :]
+    return bytes_to_image(base64.b64decode(base64_str))
+
+
+def bytes_to_image(img_data: bytes) -> Image.Image:
     """
-    # 移除 data URI 前缀（如果存在）
-    if "," in base64_str:
-        base64_str = base64_str.split(",")[1]
-    img_data = base64.b64decode(base64_str)
-    return Image.open(io.BytesIO(img_data))
+    将图片文件字节解码为 RGB 模式的 PIL Image
+
+    Args:
+        img_data: 图片文件字节
+
+    Returns:
+        RGB 模式的 PIL Image 对象
+    """
+    return open_image(io.BytesIO(img_data))
+
+
+def open_image(fp) -> Image.Image:
+    """
+    打开图片并解码为 RGB 模式的 PIL Image
+
+    Args:
+        fp: 图片文件路径或文件对象
+
+    Returns:
+        RGB 模式的 PIL Image 对象
+    """
+    image = Image.open(fp)
+
+    # pipeline 会把输入缩放到约 INPUT_TARGET_PIXELS 的面积，大尺寸 JPEG 可以在解码阶段
+    # 直接按 1/2、1/4、1/8 缩小（draft 只对 JPEG 生效，且结果不小于目标尺寸）
+    width, height = image.size
+    scale = (INPUT_TARGET_PIXELS / (width * height)) ** 0.5
+    if scale < 1:
+        image.draft("RGB", (int(width * scale), int(height * scale)))
+
+    # 只有非 RGB 图片才需要额外的转换；RGB 图片显式 load，确保在当前线程内完成解码
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    else:
+        image.load()
+    return image
 
 
 def process_uploaded_files(files):
@@ -168,12 +667,142 @@ async def health():
     return {"status": "healthy", "pipeline_loaded": pipeline is not None}
 
 
+async def decode_images(decoder, items: list) -> List[Image.Image]:
+    """
+    在线程池中并行解码输入图片，不阻塞事件循环
+
+    Args:
+        decoder: 单张图片的解码函数（base64_to_image / bytes_to_image）
+        items: 待解码的图片数据列表
+
+    Returns:
+        PIL Image 列表
+    """
+    decoded = await asyncio.gather(
+        *[asyncio.to_thread(decoder, item) for item in items],
+        return_exceptions=True,
+    )
+    pil_images = []
+    for idx, pil_image in enumerate(decoded):
+        if isinstance(pil_image, Exception):
+            logger.error(f"处理第 {idx + 1} 张图片时出错: {pil_image}")
+            raise HTTPException(
+                status_code=400,
+                detail=f"无法处理第 {idx + 1} 张图片: {str(pil_image)}",
+            )
+        pil_images.append(pil_image)
+
+    if len(pil_images) == 0:
+        raise HTTPException(
+            status_code=400,
+            detail="无法处理图片，请确保提供有效的图片",
+        )
+    return pil_images
+
+
+async def edit_images(
+    pil_images: List[Image.Image],
+    params: ImageEditParams,
+    http_request: Request,
+    response_format: str,
+    output_path: Optional[str] = None,
+):
+    """
+    执行图像编辑推理并构造响应（各图像编辑端点共用）
+
+    Args:
+        pil_images: 输入图片列表
+        params: 图像编辑参数
+        http_request: 原始 HTTP 请求
+        response_format: 查询参数 response_format（json / binary）
+        output_path: 结果图片的服务端保存路径（为 None 时在响应中返回图片）
+
+    Returns:
+        JSON 响应或二进制图片响应
+    """
+    logger.info(
+        f"API 调用: 图片数量={len(pil_images)}, "
+        f"推理步数={params.num_inference_steps}, "
+        f"引导比例={params.guidance_scale}, "
+        f"CFG比例={params.true_cfg_scale}, "
+        f"随机种子={params.seed}"
+    )
+
+    # 准备输入
+    inputs = {
+        "image": pil_images,
+        "prompt": params.prompt,
+        # 独立的生成器：torch.manual_seed 会重置全局生成器，干扰正在执行的推理
+        "generator": torch.Generator().manual_seed(params.seed),
+        "true_cfg_scale": params.true_cfg_scale,
+        "negative_prompt": params.negative_prompt or " ",
+        "num_inference_steps": int(params.num_inference_steps),
+        "guidance_scale": params.guidance_scale,
+        "num_images_per_prompt": 1,
+    }
+
+    # 提交到后台推理任务并等待结果
+    inference_start_time = time.time()
+    output_image = await submit_job(inputs)
+    inference_duration = time.time() - inference_start_time
+
+    # 编码图片（写入本地文件、二进制或 base64）
+    encoding_start_time = time.time()
+    binary = output_path is None and wants_binary(http_request, response_format)
+    # 图片编码是 CPU 密集操作，放到线程中执行，避免阻塞事件循环
+    if output_path is not None:
+        await asyncio.to_thread(
+            save_image, output_image, output_path, params.format, params.quality
+        )
+    elif binary:
+        image_bytes = await asyncio.to_thread(
+            encode_image, output_image, params.format, params.quality
+        )
+    else:
+        output_base64 = await asyncio.to_thread(
+            image_to_base64, output_image, params.format, params.quality
+        )
+    encoding_duration = time.time() - encoding_start_time
+
+    logger.info(f"API 推理完成！已处理 {len(pil_images)} 张输入图片")
+
+    if binary:
+        return binary_image_response(
+            image_bytes,
+            params.format,
+            {
+                "Inference-Time": round(inference_duration, 2),
+                "Encoding-Time": round(encoding_duration, 2),
+                "Input-Count": len(pil_images),
+            },
+        )
+
+    if output_path is not None:
+        result = {"path": output_path, "input_count": len(pil_images)}
+    else:
+        result = {"image": output_base64, "input_count": len(pil_images)}
+
+    return JSONResponse(
+        {
+            "status": "success",
+            "message": f"推理完成！已处理 {len(pil_images)} 张输入图片",
+            "result": result,
+        }
+    )
+
+
 @app.post("/v1/images/edits")
-async def image_edit(request: ImageEditRequest):
+async def image_edit(
+    request: ImageEditRequest,
+    http_request: Request,
+    response_format: Literal["json", "binary"] = "json",
+):
     """
     图像编辑 API 端点
 
-    接收 base64 编码的图片列表（支持多张），返回编辑后的图片（base64 编码）
+    接收 base64 编码的图片列表（支持多张），返回编辑后的图片（base64 编码）。
+    查询参数 response_format=binary 或请求头 Accept 为 image/* 时直接返回二进制图片，
+    计时信息放在 X-Inference-Time / X-Encoding-Time / X-Input-Count 响应头中
 
     请求体示例:
     {
@@ -186,7 +815,9 @@ async def image_edit(request: ImageEditRequest):
         "num_inference_steps": 40,
         "guidance_scale": 1.0,
         "true_cfg_scale": 4.0,
-        "seed": 0
+        "seed": 0,
+        "format": "webp",
+        "quality": 92
     }
     """
     try:
@@ -196,67 +827,108 @@ async def image_edit(request: ImageEditRequest):
         if not request.prompt or request.prompt.strip() == "":
             raise HTTPException(status_code=400, detail="请输入提示词")
 
-        # 处理 base64 编码的图片
-        pil_images = []
-        for idx, image_base64 in enumerate(request.images):
-            try:
-                pil_image = base64_to_image(image_base64)
-                # 转换为 RGB 模式（如果需要）
-                if pil_image.mode != "RGB":
-                    pil_image = pil_image.convert("RGB")
-                pil_images.append(pil_image)
-            except Exception as e:
-                logger.error(f"处理第 {idx + 1} 张图片时出错: {e}")
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"无法处理第 {idx + 1} 张图片: {str(e)}",
-                )
+        pil_images = await decode_images(base64_to_image, request.images)
+        return await edit_images(pil_images, request, http_request, response_format)
 
-        if len(pil_images) == 0:
-            raise HTTPException(
-                status_code=400,
-                detail="无法处理图片，请确保提供有效的 base64 编码图片",
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"API 推理出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"推理出错: {str(e)}")
+
+
+@app.post("/v1/images/edits/upload")
+async def image_edit_upload(
+    http_request: Request,
+    images: List[UploadFile] = File(..., description="图片文件（支持多张）"),
+    prompt: str = Form(..., description="提示词"),
+    negative_prompt: str = Form(" ", description="负面提示词"),
+    num_inference_steps: int = Form(40, description="推理步数"),
+    guidance_scale: float = Form(1.0, description="引导比例"),
+    true_cfg_scale: float = Form(4.0, description="真实 CFG 比例"),
+    seed: int = Form(0, description="随机种子"),
+    image_format: str = Form("webp", alias="format", description="输出图片格式"),
+    quality: int = Form(92, description="webp / jpeg 输出质量"),
+    response_format: Literal["json", "binary"] = "json",
+):
+    """
+    图像编辑 API 端点（multipart/form-data）
+
+    参数与 /v1/images/edits 相同，但图片以原始文件字段 images 上传，
+    省去客户端和服务端的 base64 编解码以及 33% 的传输体积膨胀
+    """
+    try:
+        try:
+            params = ImageEditParams(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                true_cfg_scale=true_cfg_scale,
+                seed=seed,
+                format=image_format,
+                quality=quality,
             )
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-        logger.info(
-            f"API 调用: 图片数量={len(pil_images)}, "
-            f"推理步数={request.num_inference_steps}, "
-            f"引导比例={request.guidance_scale}, "
-            f"CFG比例={request.true_cfg_scale}, "
-            f"随机种子={request.seed}"
-        )
+        if not images:
+            raise HTTPException(status_code=400, detail="请至少提供一张图片")
 
-        # 准备输入
-        inputs = {
-            "image": pil_images,
-            "prompt": request.prompt,
-            "generator": torch.manual_seed(request.seed),
-            "true_cfg_scale": request.true_cfg_scale,
-            "negative_prompt": request.negative_prompt or " ",
-            "num_inference_steps": int(request.num_inference_steps),
-            "guidance_scale": request.guidance_scale,
-            "num_images_per_prompt": 1,
-        }
+        if not params.prompt.strip():
+            raise HTTPException(status_code=400, detail="请输入提示词")
 
-        # 执行推理
-        with torch.inference_mode():
-            output = pipeline(**inputs)
-            output_image = output.images[0]
+        contents = [await image.read() for image in images]
+        pil_images = await decode_images(bytes_to_image, contents)
+        return await edit_images(pil_images, params, http_request, response_format)
 
-        # 转换为 base64
-        output_base64 = image_to_base64(output_image)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"API 推理出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"推理出错: {str(e)}")
 
-        logger.info(f"API 推理完成！已处理 {len(pil_images)} 张输入图片")
 
-        return JSONResponse(
-            {
-                "status": "success",
-                "message": f"推理完成！已处理 {len(pil_images)} 张输入图片",
-                "result": {
-                    "image": output_base64,
-                    "input_count": len(pil_images),
-                },
-            }
+async def image_edit_local(
+    request: ImageEditLocalRequest,
+    http_request: Request,
+    response_format: Literal["json", "binary"] = "json",
+):
+    """
+    图像编辑 API 端点（服务端本地文件路径，仅在 ENABLE_LOCAL_PATHS=1 时注册）
+
+    客户端与服务端在同一台机器上时，直接传递图片文件路径，服务端自行读取，
+    省去 base64 编解码以及通过回环网络传输图片；指定 output_path 时结果图片也直接写入该路径。
+    只接受来自本机回环地址、且不带反向代理转发头的请求，
+    所有路径都必须位于 LOCAL_PATHS_ROOT 目录之内
+
+    请求体示例:
+    {
+        "image_paths": ["/data/img1.png", "/data/img2.jpg"],
+        "prompt": "The magician bear is on the left",
+        "output_path": "/data/output.webp",
+        "format": "webp"
+    }
+    """
+    try:
+        client_host = http_request.client.host if http_request.client else ""
+        # 经反向代理转发的请求在服务端看来也来自回环地址，带转发头的一律拒绝
+        forwarded = any(header in http_request.headers for header in PROXY_HEADERS)
+        if client_host not in LOOPBACK_HOSTS or forwarded:
+            raise HTTPException(status_code=403, detail="本地路径接口只允许本机访问")
+
+        if not request.prompt or request.prompt.strip() == "":
+            raise HTTPException(status_code=400, detail="请输入提示词")
+
+        image_paths = [resolve_local_path(path) for path in request.image_paths]
+        output_path = (
+            resolve_local_path(request.output_path)
+            if request.output_path is not None
+            else None
+        )
+        pil_images = await decode_images(open_image, image_paths)
+        return await edit_images(
+            pil_images, request, http_request, response_format, output_path
         )
 
     except HTTPException:
@@ -266,7 +938,44 @@ async def image_edit(request: ImageEditRequest):
         raise HTTPException(status_code=500, detail=f"推理出错: {str(e)}")
 
 
-def inference(
+def resolve_local_path(path: str) -> str:
+    """
+    解析本地路径接口的文件路径，并确认其位于 LOCAL_PATHS_ROOT 之内
+
+    Args:
+        path: 客户端传入的文件路径
+
+    Returns:
+        解析符号链接后的绝对路径
+
+    Raises:
+        HTTPException: 路径不在允许的根目录之内
+    """
+    resolved = os.path.realpath(path)
+    if os.path.commonpath([resolved, LOCAL_PATHS_ROOT]) != LOCAL_PATHS_ROOT:
+        raise HTTPException(
+            status_code=403, detail=f"路径不在允许的目录 {LOCAL_PATHS_ROOT} 之内: {path}"
+        )
+    return resolved
+
+
+# 本地路径接口可以读写服务端文件，默认关闭；只接受本机请求，
+# 且读写范围限定在 LOCAL_PATHS_ROOT 目录之内
+LOOPBACK_HOSTS = ("127.0.0.1", "::1")
+PROXY_HEADERS = ("x-forwarded-for", "x-real-ip", "forwarded")
+LOCAL_PATHS_ROOT = None
+if os.getenv("ENABLE_LOCAL_PATHS", "0") == "1":
+    if not os.getenv("LOCAL_PATHS_ROOT"):
+        raise ValueError("ENABLE_LOCAL_PATHS=1 时必须设置 LOCAL_PATHS_ROOT 环境变量")
+    LOCAL_PATHS_ROOT = os.path.realpath(os.getenv("LOCAL_PATHS_ROOT"))
+    app.post("/v1/images/edits_local")(image_edit_local)
+    logger.info(
+        "已启用本地路径接口 /v1/images/edits_local"
+        f"（仅限本机访问，允许目录: {LOCAL_PATHS_ROOT}）"
+    )
+
+
+async def inference(
     files,
     prompt,
     negative_prompt=" ",
@@ -276,7 +985,7 @@ def inference(
     seed=0,
 ):
     """
-    执行图像编辑推理
+    执行图像编辑推理（Gradio 界面调用，与 API 请求共用后台推理队列）
 
     Args:
         files: 上传的图片文件列表（可以是任意数量）
@@ -298,7 +1007,7 @@ def inference(
 
     try:
         # 处理上传的图片文件
-        images = process_uploaded_files(files)
+        images = await asyncio.to_thread(process_uploaded_files, files)
 
         if len(images) == 0:
             logger.warning("无法处理上传的图片，请确保上传的是有效的图片文件")
@@ -316,7 +1025,7 @@ def inference(
         inputs = {
             "image": images,
             "prompt": prompt,
-            "generator": torch.manual_seed(seed),
+            "generator": torch.Generator().manual_seed(int(seed)),
             "true_cfg_scale": true_cfg_scale,
             "negative_prompt": negative_prompt,
             "num_inference_steps": int(num_inference_steps),
@@ -325,9 +1034,7 @@ def inference(
         }
 
         # 执行推理
-        with torch.inference_mode():
-            output = pipeline(**inputs)
-            output_image = output.images[0]
+        output_image = await submit_job(inputs)
 
         logger.info(f"推理完成！已处理 {len(images)} 张输入图片")
         return output_image, f"推理完成！已处理 {len(images)} 张输入图片"
@@ -451,29 +1158,18 @@ with gr.Blocks(title="Qwen Image Edit Plus") as demo:
     )
 
 
+# 将 Gradio 界面挂载到 FastAPI 应用的根路径：API 与界面共用同一端口和事件循环，
+# Gradio 的推理请求与 API 请求进入同一个后台推理队列
+app = gr.mount_gradio_app(app, demo, path="/")
+
+
 if __name__ == "__main__":
     import uvicorn
-    import threading
 
     # 获取配置
     host = os.getenv("GRADIO_HOST", "0.0.0.0")
 
-    # Gradio 端口
-    gradio_port_env = os.getenv("GRADIO_PORT")
-    if gradio_port_env:
-        try:
-            gradio_port = int(gradio_port_env)
-            logger.info(f"从环境变量 GRADIO_PORT 获取端口: {gradio_port}")
-        except ValueError:
-            logger.warning(
-                f"环境变量 GRADIO_PORT 的值 '{gradio_port_env}' 不是有效数字，使用默认端口 8099"
-            )
-            gradio_port = 8099
-    else:
-        gradio_port = 8099
-        logger.info(f"环境变量 GRADIO_PORT 未设置，使用默认端口: {gradio_port}")
-
-    # API 端口（默认比 Gradio 端口大 1）
+    # 服务端口（API 与 Gradio 界面共用）
     api_port_env = os.getenv("API_PORT")
     if api_port_env:
         try:
@@ -481,29 +1177,16 @@ if __name__ == "__main__":
             logger.info(f"从环境变量 API_PORT 获取端口: {api_port}")
         except ValueError:
             logger.warning(
-                f"环境变量 API_PORT 的值 '{api_port_env}' "
-                f"不是有效数字，使用默认端口 {gradio_port + 1}"
+                f"环境变量 API_PORT 的值 '{api_port_env}' 不是有效数字，使用默认端口 8100"
             )
-            api_port = gradio_port + 1
+            api_port = 8100
     else:
-        api_port = gradio_port + 1
+        api_port = 8100
         logger.info(f"环境变量 API_PORT 未设置，使用默认端口: {api_port}")
 
-    # 在后台线程启动 Gradio
-    def run_gradio():
-        logger.info(f"正在启动 Gradio 服务器，地址: http://{host}:{gradio_port}")
-        demo.launch(
-            server_name=host,
-            server_port=gradio_port,
-            share=False,
-        )
-
-    gradio_thread = threading.Thread(target=run_gradio, daemon=True)
-    gradio_thread.start()
-
     # 启动 FastAPI 服务器
     logger.info(f"正在启动 FastAPI 服务器，地址: http://{host}:{api_port}")
     logger.info(f"API 文档地址: http://{host}:{api_port}/docs")
-    logger.info(f"Gradio 界面地址: http://{host}:{gradio_port}")
+    logger.info(f"Gradio 界面地址: http://{host}:{api_port}/")
 
     uvicorn.run(app, host=host, port=api_port, log_level="info")
@@ -5,39 +5,407 @@
 
 import os
 import sys
-import base64
+import json
+import mmap
+import time
+import asyncio
+import hashlib
+import functools
 import argparse
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
+try:
+    # pybase64 使用 SIMD（SSSE3 / AVX2 / NEON）加速 base64 编解码，接口与标准库一致
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+try:
+    # orjson 使用 SIMD 扫描需要转义的字符，序列化 / 解析数 MB 的 base64 字符串远快于标准库 json
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # blake3 使用 SIMD 计算哈希，用作 base64 缓存的键
+    from blake3 import blake3 as _cache_hash
+except ImportError:
+    # 与 blake3 默认输出长度一致（32 字节）
+    _cache_hash = functools.partial(hashlib.blake2b, digest_size=32)
+
+try:
+    # requests_toolbelt 的 MultipartEncoder 边读文件边发送 multipart 请求体，不在内存中拼接整个请求
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
+
+
+def json_dumps(obj) -> bytes:
+    """
+    将对象序列化为 UTF-8 编码的 JSON 字节（优先使用 orjson）
+
+    Args:
+        obj: 待序列化的对象
+
+    Returns:
+        JSON 字节
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def json_loads(data: bytes):
+    """
+    解析 JSON 字节（优先使用 orjson）
+
+    Args:
+        data: JSON 字节
+
+    Returns:
+        解析后的对象
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# 模块级会话：复用 TCP 连接（HTTP keep-alive），循环调用时省去每次请求的握手开销
+_SESSION = requests.Session()
+# urllib3 默认已设置 TCP_NODELAY；不设置 SO_SNDBUF，显式设置会关闭 Linux 的发送缓冲区自动调节，
+# 且被 net.core.wmem_max 截断，通常反而比自动调节的缓冲区小
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.headers["Connection"] = "keep-alive"
+# base64 / 图片数据几乎不可压缩，不请求 gzip，省去两端的压缩与解压开销
+_SESSION.headers["Accept-Encoding"] = "identity"
+
+
+# 分块 base64 编码的块大小（3 的倍数，保证分块编码结果与整体编码完全一致）
+ENCODE_CHUNK_SIZE = 3 * 65536
 
-def image_to_base64(image_path: str) -> str:
+# 二进制响应流式写入文件时的块大小
+STREAM_CHUNK_SIZE = 1 << 20
+
+# 错误响应最多读取的字节数
+ERROR_DETAIL_LIMIT = 4096
+
+# 图片扩展名对应的 MIME 类型
+_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".bmp": "image/bmp",
+    ".webp": "image/webp",
+}
+
+# 预先编码好的 data URI 前缀（ASCII 字节），编码时直接写入缓冲区，不再逐次格式化字符串
+_DATA_URI_PREFIXES = {
+    mime_type: b"data:" + mime_type.encode("ascii") + b";base64,"
+    for mime_type in set(_MIME_TYPES.values())
+}
+
+
+def image_mime_type(image_path: str) -> str:
     """
-    将图片文件转换为 base64 编码的字符串（包含 data URI 前缀）
+    根据文件扩展名确定图片的 MIME 类型
 
     Args:
         image_path: 图片文件路径
 
     Returns:
-        base64 编码的图片字符串（包含 data URI 前缀）
+        MIME 类型（无法识别时为 image/png）
     """
+    dot = image_path.rfind(".")
+    # 点号出现在最后一个路径分隔符之前时（如 ./dir/file），文件名没有扩展名
+    if dot <= image_path.rfind(os.sep):
+        return "image/png"
+    return _MIME_TYPES.get(image_path[dot:].lower(), "image/png")
+
+
+def _data_uri_prefix(mime_type: str) -> bytes:
+    """
+    获取 data URI 前缀（ASCII 字节）
+
+    Args:
+        mime_type: 图片的 MIME 类型
+
+    Returns:
+        形如 b"data:image/png;base64," 的前缀
+    """
+    prefix = _DATA_URI_PREFIXES.get(mime_type)
+    if prefix is None:
+        prefix = b"data:" + mime_type.encode("ascii") + b";base64,"
+    return prefix
+
+
+def data_uri_length(mime_type: str, size: int) -> int:
+    """
+    计算 data URI 的精确长度，用于预先分配缓冲区
+
+    Args:
+        mime_type: 图片的 MIME 类型
+        size: 图片文件大小（字节）
+
+    Returns:
+        data URI 的字节数（前缀 + base64 编码结果）
+    """
+    return len(_data_uri_prefix(mime_type)) + (size + 2) // 3 * 4
+
+
+def _encode_into(out: memoryview, image_path: str, mime_type: str, size: int):
+    """
+    将图片文件以 data URI 形式分块 base64 编码，写入预先分配好的缓冲区
+
+    Args:
+        out: 输出缓冲区，长度必须等于 data_uri_length(mime_type, size)
+        image_path: 图片文件路径
+        mime_type: 图片的 MIME 类型
+        size: 分配缓冲区时的图片文件大小（字节）
+    """
+    prefix = _data_uri_prefix(mime_type)
+    out[: len(prefix)] = prefix
+    pos = len(prefix)
     with open(image_path, "rb") as image_file:
-        img_data = image_file.read()
-        img_base64 = base64.b64encode(img_data).decode()
+        if os.fstat(image_file.fileno()).st_size != size:
+            raise RuntimeError("图片文件在读取过程中被修改")
+        # 不足一页的小文件直接读取，mmap 的建立开销超过拷贝本身
+        if size < mmap.PAGESIZE:
+            out[pos:] = base64.b64encode(image_file.read())
+            return
+
+        # 大文件通过 mmap 由页缓存按需提供数据，省去把整个文件读入内存的复制
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                for start in range(0, size, ENCODE_CHUNK_SIZE):
+                    encoded = base64.b64encode(view[start : start + ENCODE_CHUNK_SIZE])
+                    out[pos : pos + len(encoded)] = encoded
+                    pos += len(encoded)
+
+
+def _encode_cached(
+    out: memoryview,
+    image_path: str,
+    mime_type: str,
+    size: int,
+    cache_dir: Optional[str] = None,
+):
+    """
+    与 _encode_into 相同，但优先从磁盘缓存读取编码结果，未命中时编码后写入缓存
+
+    缓存键为（绝对路径, 修改时间, 文件大小, MIME 类型）的哈希，
+    同一批图片多次调用（例如遍历提示词 / 随机种子）时省去重复的 base64 编码
+
+    Args:
+        out: 输出缓冲区，长度必须等于 data_uri_length(mime_type, size)
+        image_path: 图片文件路径
+        mime_type: 图片的 MIME 类型
+        size: 分配缓冲区时的图片文件大小（字节）
+        cache_dir: 缓存目录（为 None 时不使用缓存）
+    """
+    if cache_dir is None:
+        _encode_into(out, image_path, mime_type, size)
+        return
+
+    st = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}\0{st.st_mtime_ns}\0{st.st_size}\0{mime_type}"
+    cache_path = os.path.join(
+        cache_dir, _cache_hash(key.encode("utf-8")).hexdigest() + ".b64"
+    )
+
+    # 命中时直接把缓存文件读入请求体中对应的位置
+    try:
+        with open(cache_path, "rb") as cache_file:
+            if os.fstat(cache_file.fileno()).st_size == len(out):
+                if cache_file.readinto(out) == len(out):
+                    return
+    except FileNotFoundError:
+        pass
+
+    _encode_into(out, image_path, mime_type, size)
+
+    # 先写临时文件再原子替换，避免并发运行时读到写了一半的缓存
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as cache_file:
+        cache_file.write(out)
+    os.replace(tmp_path, cache_path)
+
+
+def build_request_body(
+    image_paths: List[str], fields: dict, cache_dir: Optional[str] = None
+) -> bytearray:
+    """
+    在一个按精确长度预先分配的 bytearray 中直接拼装 JSON 请求体
+
+    多张图片在线程池中并行编码（base64 编码和磁盘读取都不持有 GIL），写入 images 数组中各自的位置，
+    不再经过 bytes -> str -> 列表 -> json.dumps 的多次复制；
+    base64 字符不需要 JSON 转义，其余字段用 json_dumps 序列化
 
-        # 根据文件扩展名确定 MIME 类型
-        ext = os.path.splitext(image_path)[1].lower()
-        mime_types = {
-            ".png": "image/png",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".gif": "image/gif",
-            ".bmp": "image/bmp",
-            ".webp": "image/webp",
-        }
-        mime_type = mime_types.get(ext, "image/png")
+    Args:
+        image_paths: 图片文件路径列表
+        fields: 除 images 外的其他请求字段（不能为空）
+        cache_dir: base64 缓存目录（为 None 时不使用缓存）
 
-        return f"data:{mime_type};base64,{img_base64}"
+    Returns:
+        JSON 请求体
+    """
+    header = b'{"images":['
+    # 去掉序列化结果开头的 "{"，接在 images 数组之后
+    tail = b"]," + json_dumps(fields)[1:]
+    mime_types = [image_mime_type(p) for p in image_paths]
+    sizes = [os.path.getsize(p) for p in image_paths]
+    lengths = [data_uri_length(m, n) for m, n in zip(mime_types, sizes)]
+
+    # base64 输出长度可以由文件大小精确算出，一次分配整个请求体，不再随追加反复扩容复制；
+    # 每张图片两侧各一个引号，图片之间一个逗号
+    count = len(image_paths)
+    total = len(header) + sum(lengths) + 2 * count + max(count - 1, 0) + len(tail)
+    body = bytearray(total)
+
+    max_workers = max(1, min(8, count, os.cpu_count() or 1))
+    with memoryview(body) as view:
+        view[: len(header)] = header
+        view[total - len(tail) :] = tail
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # 各线程写入互不重叠的切片
+            futures = []
+            pos = len(header)
+            for idx, (img_path, mime_type, size, length) in enumerate(
+                zip(image_paths, mime_types, sizes, lengths)
+            ):
+                if idx:
+                    view[pos] = ord(",")
+                    pos += 1
+                view[pos] = ord('"')
+                pos += 1
+                out = view[pos : pos + length]
+                futures.append(
+                    pool.submit(
+                        _encode_cached, out, img_path, mime_type, size, cache_dir
+                    )
+                )
+                pos += length
+                view[pos] = ord('"')
+                pos += 1
+
+            for img_path, future in zip(image_paths, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"  ✗ 读取失败: {img_path} - {e}")
+                    raise
+                print(f"  ✓ 已读取: {img_path}")
+    return body
+
+
+def post_multipart(
+    api_url: str,
+    image_paths: List[str],
+    fields: dict,
+    headers: Optional[dict] = None,
+):
+    """
+    以 multipart/form-data 形式上传原始图片文件，省去 base64 编码和 33% 的体积膨胀
+
+    Args:
+        api_url: multipart 端点 URL（/v1/images/edits/upload）
+        image_paths: 图片文件路径列表
+        fields: 除 images 外的其他请求字段
+        headers: 额外的请求头
+
+    Returns:
+        requests.Response 对象
+    """
+    # 值为 None 的字段不发送，由服务端使用默认值（str(None) 会变成字符串 "None"）
+    form_fields = [
+        (key, str(value)) for key, value in fields.items() if value is not None
+    ]
+    image_files = [open(p, "rb") for p in image_paths]
+    try:
+        files = [
+            ("images", (os.path.basename(p), f, image_mime_type(p)))
+            for p, f in zip(image_paths, image_files)
+        ]
+
+        if MultipartEncoder is not None:
+            encoder = MultipartEncoder(fields=form_fields + files)
+            response = _SESSION.post(
+                api_url,
+                data=encoder,
+                headers={**(headers or {}), "Content-Type": encoder.content_type},
+                stream=True,
+                timeout=300,
+            )
+        else:
+            response = _SESSION.post(
+                api_url,
+                data=form_fields,
+                files=files,
+                headers=headers,
+                stream=True,
+                timeout=300,
+            )
+        # 文件内容在发送请求时才被读取，请求发出后再输出
+        for img_path in image_paths:
+            print(f"  ✓ 已上传: {img_path}")
+        return response
+    finally:
+        for f in image_files:
+            f.close()
+
+
+def error_detail(response, limit: int = ERROR_DETAIL_LIMIT):
+    """
+    读取错误响应的详情，最多读取 limit 字节，避免服务端回显大请求体时占用大量内存
+
+    Args:
+        response: requests.Response 对象（stream=True，响应体尚未读取）
+        limit: 最多读取的字节数
+
+    Returns:
+        解析后的 JSON 对象；无法解析时为截断后的文本
+    """
+    try:
+        blob = response.raw.read(limit, decode_content=True)
+    finally:
+        response.close()
+    try:
+        return json_loads(blob)
+    except Exception:
+        return blob.decode("utf-8", "replace")
+
+
+def write_file(output_path: str, data: bytes):
+    """
+    用 os.open + os.write 直接写入文件，跳过 Python 缓冲写入层
+
+    Args:
+        output_path: 输出文件路径
+        data: 文件内容
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(output_path, flags, 0o644)
+    try:
+        # 按最终大小预先分配磁盘空间，避免边写边扩展文件（文件系统不支持时忽略）
+        if data and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, len(data))
+            except OSError:
+                pass
+        with memoryview(data) as view:
+            written = 0
+            while written < len(view):
+                written += os.write(fd, view[written:])
+    finally:
+        os.close(fd)
 
 
 def base64_to_image_file(base64_str: str, output_path: str):
@@ -48,13 +416,44 @@ def base64_to_image_file(base64_str: str, output_path: str):
         base64_str: base64 编码的图片字符串（可以包含或不包含 data URI 前缀）
         output_path: 输出文件路径
     """
-    # 移除 data URI 前缀（如果存在）
-    if "," in base64_str:
-        base64_str = base64_str.split(",")[1]
+    # 移除 data URI 前缀（如果存在）；逗号只会出现在开头的短前缀中，限定查找范围，
+    # 不再对整个（可能数十 MB 的）字符串做 in + split 两次完整扫描
+    if base64_str.startswith("data:"):
+        base64_str = base64_str[base64_str.find(",", 0, 64) + 1 :]
+
+    # 服务端返回的数据可信，跳过逐字符校验
+    write_file(output_path, base64.b64decode(base64_str, validate=False))
+
+
+def mime_extension(mime_type: str) -> str:
+    """
+    根据图片 MIME 类型确定扩展名
+
+    Args:
+        mime_type: MIME 类型（例如 image/webp，可以带 ; 参数）
+
+    Returns:
+        图片扩展名（无法识别时为 .png）
+    """
+    if mime_type.startswith("image/"):
+        subtype = mime_type[len("image/") :].split(";", 1)[0].strip()
+        return ".jpg" if subtype == "jpeg" else f".{subtype}"
+    return ".png"
+
+
+def image_extension(base64_str: str) -> str:
+    """
+    根据 data URI 前缀中的 MIME 类型确定图片扩展名
+
+    Args:
+        base64_str: base64 编码的图片字符串（可以包含或不包含 data URI 前缀）
 
-    img_data = base64.b64decode(base64_str)
-    with open(output_path, "wb") as f:
-        f.write(img_data)
+    Returns:
+        图片扩展名（无法识别时为 .png）
+    """
+    if base64_str.startswith("data:"):
+        return mime_extension(base64_str[len("data:") : base64_str.find(";", 0, 64)])
+    return ".png"
 
 
 def test_image_edit(
@@ -66,7 +465,12 @@ def test_image_edit(
     guidance_scale: float = 1.0,
     true_cfg_scale: float = 4.0,
     seed: int = 0,
+    image_format: str = "webp",
     output_path: Optional[str] = None,
+    binary: bool = False,
+    multipart: bool = False,
+    cache_dir: Optional[str] = None,
+    local: bool = False,
 ):
     """
     测试图像编辑 API
@@ -80,7 +484,14 @@ def test_image_edit(
         guidance_scale: 引导比例
         true_cfg_scale: 真实 CFG 比例
         seed: 随机种子
+        image_format: 输出图片格式（webp / jpeg / png）
         output_path: 输出图片保存路径（如果为 None，则自动生成）
+        binary: 是否请求二进制图片响应（Accept: application/octet-stream），
+            响应体直接写入文件，省去 base64 解码
+        multipart: 是否以 multipart/form-data 上传原始图片（发送到 {api_url}/upload）
+        cache_dir: base64 缓存目录（为 None 时不使用缓存，multipart 模式下忽略）
+        local: 是否只发送图片的服务端本地路径，由服务端直接读取图片并写入结果
+            （发送到 {api_url}_local，需服务端设置 ENABLE_LOCAL_PATHS=1）
 
     Returns:
         响应数据（字典）
@@ -90,28 +501,34 @@ def test_image_edit(
         if not os.path.exists(img_path):
             raise FileNotFoundError(f"图片文件不存在: {img_path}")
 
-    # 将图片转换为 base64
     print(f"正在读取 {len(image_paths)} 张图片...")
-    images_base64 = []
-    for img_path in image_paths:
-        try:
-            img_base64 = image_to_base64(img_path)
-            images_base64.append(img_base64)
-            print(f"  ✓ 已读取: {img_path}")
-        except Exception as e:
-            print(f"  ✗ 读取失败: {img_path} - {e}")
-            raise
-
-    # 构建请求体
-    request_data = {
-        "images": images_base64,
+    request_fields = {
         "prompt": prompt,
         "negative_prompt": negative_prompt,
         "num_inference_steps": num_inference_steps,
         "guidance_scale": guidance_scale,
         "true_cfg_scale": true_cfg_scale,
         "seed": seed,
+        "format": image_format,
     }
+    if local:
+        # 服务端直接读取本地图片文件，并把结果写入 output_path
+        api_url = api_url.rstrip("/") + "_local"
+        if output_path is None:
+            base_name = os.path.splitext(os.path.basename(image_paths[0]))[0]
+            output_path = f"output_{base_name}{mime_extension('image/' + image_format)}"
+        body = json_dumps(
+            {
+                "image_paths": [os.path.abspath(p) for p in image_paths],
+                "output_path": os.path.abspath(output_path),
+                **request_fields,
+            }
+        )
+    elif multipart:
+        api_url = api_url.rstrip("/") + "/upload"
+    else:
+        # 构建请求体：图片分块编码为 base64，直接写入 JSON 请求体
+        body = build_request_body(image_paths, request_fields, cache_dir)
 
     print(f"\n正在发送请求到: {api_url}")
     print(f"提示词: {prompt}")
@@ -122,12 +539,52 @@ def test_image_edit(
     )
     print(params_msg)
 
+    # 请求二进制响应时服务端直接返回图片字节，不再经过 base64 + JSON
+    headers = {"Accept": "application/octet-stream"} if binary else {}
+
     # 发送 POST 请求
     try:
-        response = requests.post(api_url, json=request_data, timeout=300)
+        if multipart:
+            response = post_multipart(api_url, image_paths, request_fields, headers)
+        else:
+            # bytearray 会被 requests 直接作为请求体发送，不再额外复制
+            response = _SESSION.post(
+                api_url,
+                data=body,
+                headers={**headers, "Content-Type": "application/json"},
+                stream=True,
+                timeout=300,
+            )
         response.raise_for_status()
 
-        result = response.json()
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith("image/"):
+            # 如果没有指定输出路径，自动生成
+            if output_path is None:
+                base_name = os.path.splitext(os.path.basename(image_paths[0]))[0]
+                output_path = f"output_{base_name}{mime_extension(content_type)}"
+
+            # 流式写入文件，不在内存中缓存整个响应体
+            with open(output_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+
+            input_count = int(response.headers.get("X-Input-Count", len(image_paths)))
+            result = {
+                "status": "success",
+                "message": f"推理完成！已处理 {input_count} 张输入图片",
+                "result": {"path": output_path, "input_count": input_count},
+            }
+            print("\n✓ 请求成功！")
+            print(f"  {result['message']}")
+            print(
+                f"  推理耗时: {response.headers.get('X-Inference-Time')}s, "
+                f"编码耗时: {response.headers.get('X-Encoding-Time')}s"
+            )
+            print(f"  ✓ 结果图片已保存到: {output_path}")
+            return result
+
+        result = json_loads(response.content)
 
         if result.get("status") == "success":
             print("\n✓ 请求成功！")
@@ -140,10 +597,13 @@ def test_image_edit(
                 # 如果没有指定输出路径，自动生成
                 if output_path is None:
                     base_name = os.path.splitext(os.path.basename(image_paths[0]))[0]
-                    output_path = f"output_{base_name}.png"
+                    ext = image_extension(output_image_base64)
+                    output_path = f"output_{base_name}{ext}"
 
                 base64_to_image_file(output_image_base64, output_path)
                 print(f"  ✓ 结果图片已保存到: {output_path}")
+            elif "result" in result and "path" in result["result"]:
+                print(f"  ✓ 结果图片已由服务端保存到: {result['result']['path']}")
             else:
                 print("  ⚠ 响应中未找到图片数据")
         else:
@@ -157,18 +617,84 @@ def test_image_edit(
     except requests.exceptions.HTTPError as e:
         print(f"\n✗ HTTP 错误: {e}")
         if e.response is not None:
-            try:
-                error_detail = e.response.json()
-                print(f"  错误详情: {error_detail}")
-            except Exception:
-                print(f"  响应内容: {e.response.text}")
+            print(f"  错误详情: {error_detail(e.response)}")
         raise
     except requests.exceptions.RequestException as e:
         print(f"\n✗ 请求异常: {e}")
         raise
 
 
-def main():
+async def test_image_edit_async(**kwargs):
+    """
+    test_image_edit 的异步版本：在线程池中执行请求，不阻塞事件循环
+
+    Args:
+        **kwargs: 传给 test_image_edit 的参数
+
+    Returns:
+        响应数据（字典）
+    """
+    return await asyncio.to_thread(test_image_edit, **kwargs)
+
+
+async def run_concurrent(cases: List[dict], concurrency: int = 4) -> list:
+    """
+    在一个事件循环中并发执行多个图像编辑请求（例如遍历提示词 / 随机种子的吞吐测试）
+
+    Args:
+        cases: 每个请求的 test_image_edit 参数
+        concurrency: 最大并发请求数
+
+    Returns:
+        与 cases 顺序一致的结果列表，失败的请求对应异常对象
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(case: dict):
+        async with semaphore:
+            return await test_image_edit_async(**case)
+
+    start_time = time.time()
+    results = await asyncio.gather(
+        *[run(case) for case in cases], return_exceptions=True
+    )
+    duration = time.time() - start_time
+
+    succeeded = sum(1 for r in results if not isinstance(r, Exception))
+    print(
+        f"\n共 {len(cases)} 个请求，成功 {succeeded} 个，总耗时 {duration:.2f}s，"
+        f"吞吐 {succeeded / duration:.3f} 张/s"
+    )
+    return results
+
+
+def positive_int(value: str) -> int:
+    """
+    argparse 类型函数：解析大于等于 1 的整数
+
+    Args:
+        value: 命令行参数字符串
+
+    Returns:
+        解析后的整数
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必须是大于等于 1 的整数: {value}")
+    return number
+
+
+# 命令行解析器，首次调用 main 时构建，之后复用
+_parser: Optional[argparse.ArgumentParser] = None
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    """
+    构建命令行参数解析器
+
+    Returns:
+        argparse.ArgumentParser 对象
+    """
     parser = argparse.ArgumentParser(
         description="测试 Qwen Image Edit Plus API",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -194,6 +720,18 @@ def main():
                  --true-cfg-scale 5.0 \
                  --seed 42 \
                  --output result.png
+
+  # 并发发送 8 个请求（随机种子 0~7），最多 4 个同时进行
+  python test.py --api-url http://localhost:8100/v1/images/edits \
+                 --image test.jpg \
+                 --prompt "The magician bear is on the left" \
+                 --repeat 8 --concurrency 4
+
+  # multipart/form-data 上传原始图片（不做 base64 编码）
+  python test.py --api-url http://localhost:8100/v1/images/edits \
+                 --image img1.jpg img2.jpg \
+                 --prompt "The magician bear is on the left" \
+                 --multipart
         """,
     )
 
@@ -246,27 +784,105 @@ def main():
         default=0,
         help="随机种子（默认：0）",
     )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["webp", "jpeg", "png"],
+        default="webp",
+        help="输出图片格式（默认：webp）",
+    )
     parser.add_argument(
         "--output",
         type=str,
         default=None,
         help="输出图片保存路径（默认：自动生成）",
     )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="请求二进制图片响应，直接写入文件（不经过 base64 / JSON）",
+    )
+    parser.add_argument(
+        "--multipart",
+        action="store_true",
+        help="以 multipart/form-data 上传原始图片文件（发送到 <api-url>/upload）",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="base64 编码结果的缓存目录，同一批图片多次调用时复用（例如：.b64cache）",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="与服务端在同一台机器上时只发送图片路径，由服务端读写文件（发送到 <api-url>_local）",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=positive_int,
+        default=1,
+        help="请求次数，随机种子依次递增，结果文件名带上种子（默认：1）",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=positive_int,
+        default=4,
+        help="--repeat 大于 1 时的最大并发请求数（默认：4）",
+    )
+
+    return parser
 
-    args = parser.parse_args()
+
+def main(argv: Optional[List[str]] = None):
+    """
+    命令行入口
+
+    Args:
+        argv: 命令行参数（为 None 时使用 sys.argv[1:]）
+
+    Returns:
+        进程退出码
+    """
+    global _parser
+    if _parser is None:
+        _parser = _build_parser()
+    args = _parser.parse_args(argv)
+
+    case = {
+        "api_url": args.api_url,
+        "image_paths": args.image,
+        "prompt": args.prompt,
+        "negative_prompt": args.negative_prompt,
+        "num_inference_steps": args.num_inference_steps,
+        "guidance_scale": args.guidance_scale,
+        "true_cfg_scale": args.true_cfg_scale,
+        "seed": args.seed,
+        "image_format": args.format,
+        "output_path": args.output,
+        "binary": args.binary,
+        "multipart": args.multipart,
+        "cache_dir": args.cache_dir,
+        "local": args.local,
+    }
 
     try:
-        test_image_edit(
-            api_url=args.api_url,
-            image_paths=args.image,
-            prompt=args.prompt,
-            negative_prompt=args.negative_prompt,
-            num_inference_steps=args.num_inference_steps,
-            guidance_scale=args.guidance_scale,
-            true_cfg_scale=args.true_cfg_scale,
-            seed=args.seed,
-            output_path=args.output,
-        )
+        if args.repeat > 1:
+            if args.output is not None:
+                root, ext = os.path.splitext(args.output)
+            else:
+                root = "output_" + os.path.splitext(os.path.basename(args.image[0]))[0]
+                ext = mime_extension("image/" + args.format)
+            cases = [
+                {**case, "seed": seed, "output_path": f"{root}_{seed}{ext}"}
+                for seed in range(args.seed, args.seed + args.repeat)
+            ]
+            results = asyncio.run(run_concurrent(cases, args.concurrency))
+            if any(isinstance(r, Exception) for r in results):
+                print("\n测试失败: 部分请求出错", file=sys.stderr)
+                return 1
+        else:
+            test_image_edit(**case)
         print("\n测试完成！")
         return 0
     except Exception as e: